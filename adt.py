@@ -13,18 +13,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, namedtuple, Counter
 from itertools import zip_longest, chain
+from functools import lru_cache, partial
+from array import array
+from weakref import WeakValueDictionary
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from types import FunctionType, CodeType
+from time import perf_counter
+import textwrap
+import hashlib
+import marshal
+import dis
+import operator
+import pickle
 import inspect
+import sys
+import os
 import ast
 import re
 
 class Singleton:
     """Mix-in for making singleton types."""
+    __slots__ = ()
+
     def __new__(cls):
+        # Look in the class's own namespace so subclasses don't
+        # pick up the instance of a base class.
         try:
-            return cls._instance
-        except AttributeError:
+            return cls.__dict__['_instance']
+        except KeyError:
             cls._instance = super().__new__(cls)
         return cls._instance
 
@@ -47,10 +66,17 @@ class Require(Constraint, namedtuple('Required', 'dtype')):
 class AlgebraicMeta(type):
     """Metaclass for Algebraic Data Types."""
     @classmethod
-    def __prepare__(metacls, name, bases):
+    def __prepare__(metacls, name, bases, **options):
         return OrderedDict()
 
-    def __new__(metacls, name, bases, clsdict):
+    def __new__(metacls, name, bases, clsdict, slots=True, intern=False,
+                check=True):
+        # Instances only hold their fields, so don't give them a
+        # __dict__ unless the class is defined with slots=False.
+        # Interned instances need one (and to be weakly referenceable).
+        if slots and not intern:
+            clsdict.setdefault('__slots__', ())
+
         if bases is ():
             # Constructing the base class,
             # so there is no need to do anything.
@@ -70,16 +96,82 @@ class AlgebraicMeta(type):
         clsdict['_constraints'] = [clsdict[key] for key in fields]
         for key in fields:
             del clsdict[key]
+        # Variants defined with check=False never check their constraints.
+        clsdict['_check'] = check
 
         bases = ( namedtuple(name + 'Tuple', fields), ) + bases
         if len(fields) < 1:
             # If the type constructor takes no arguments, all the
             # instance must be identical making it a natural singleton.
             bases = ( Singleton, ) + bases
+        elif intern:
+            bases = ( Interned, ) + bases
+            clsdict['_interned'] = WeakValueDictionary()
+        if not intern and '__init__' not in clsdict:
+            clsdict['__init__'] = make_init(fields, clsdict['_constraints']
+                                            if check else [])
         cls = type.__new__(metacls, name, bases, clsdict)
         cls._variants.append(cls)
         return cls
 
+    def __init__(cls, name, bases, clsdict, **options):
+        super().__init__(name, bases, clsdict)
+
+def make_init(fields, constraints):
+    """Generate an __init__ for a variant with the given fields that
+    checks their constraints, with the checks for Require inlined
+    and those for Anything left out.
+    """
+    # Names in the generated code start with an underscore
+    # so they can't clash with the fields.
+    env = {'_isinstance': isinstance, '_Binding': Binding,
+           '_checking': checking}
+    lines = ['def __init__(_self%s):' % ''.join(', ' + f for f in fields),
+             '    """Construct an instance of the type."""',
+             '    if not _checking.enabled: return']
+    for index, (field, constraint) in enumerate(zip(fields, constraints)):
+        if type(constraint) is Anything:
+            continue
+        env['_c%d' % index] = constraint
+        if type(constraint) is Require:
+            # Bindings are accepted anywhere, so that
+            # patterns can be built from the type.
+            env['_t%d' % index] = (constraint.dtype, Binding)
+            test = '_isinstance(%s, _t%d)' % (field, index)
+        else:
+            test = '_isinstance(%s, _Binding)' % field
+        lines.append('    if not %s: _c%d.check(%s)' % (test, index, field))
+    if len(lines) == 3:
+        # Nothing to check.
+        del lines[2:]
+        lines.append('    pass')
+    exec('\n'.join(lines), env)
+    return env['__init__']
+
+class Checking:
+    """The global switch for checking constraints when constructing
+    instances. Checking is on unless the ADT_CHECK_CONSTRAINTS
+    environment variable is set to 0 when this module is imported.
+    It can be turned off temporarily with 'unchecked()'.
+    """
+    def __init__(self):
+        self.enabled = os.environ.get('ADT_CHECK_CONSTRAINTS') != '0'
+
+checking = Checking()
+
+@contextmanager
+def unchecked():
+    """Context manager that turns off constraint checking, for hot
+    paths that only build values from values known to be valid.
+    This affects all threads.
+    """
+    previous = checking.enabled
+    checking.enabled = False
+    try:
+        yield
+    finally:
+        checking.enabled = previous
+
 class ADT(metaclass=AlgebraicMeta):
     """Base class for algebraic data types."""
     def __new__(cls, *args, **kwargs):
@@ -88,6 +180,8 @@ class ADT(metaclass=AlgebraicMeta):
 
     def __init__(self, *args, **kwargs):
         """Construct an instance of the type."""
+        if not (self._check and checking.enabled):
+            return
         for field, constraint in zip(self._fields, self._constraints):
             value = getattr(self, field)
             if isinstance(value, Binding):
@@ -97,6 +191,681 @@ class ADT(metaclass=AlgebraicMeta):
             else:
                 constraint.check(value)
 
+    @classmethod
+    def from_columns(cls, *columns):
+        """Construct instances of the variant from a column of values
+        for each of its fields. Each column's constraint is checked
+        once for the whole column, and the instances are then built
+        without checking each of them again.
+        """
+        if not hasattr(cls, '_fields'):
+            raise TypeError("can't instantiate")
+        if len(columns) != len(cls._fields):
+            raise TypeError("expected %d columns, got %d" %
+                            (len(cls._fields), len(columns)))
+        columns = [column if hasattr(column, '__len__') else list(column)
+                   for column in columns]
+        if len(set(map(len, columns))) > 1:
+            raise ValueError("columns have different lengths")
+        if cls._check and checking.enabled:
+            for constraint, column in zip(cls._constraints, columns):
+                check_column(constraint, column)
+        if issubclass(cls, Interned):
+            return [cls(*row) for row in zip(*columns)]
+        return list(map(partial(tuple.__new__, cls), zip(*columns)))
+
+    @classmethod
+    def bulk(cls, rows):
+        """Construct instances of the variant from an iterable of
+        tuples of field values, like 'from_columns'.
+        """
+        rows = list(rows)
+        if any(len(row) != len(cls._fields) for row in rows):
+            raise TypeError("expected rows of %d values" %
+                            len(cls._fields))
+        columns = list(zip(*rows)) or [()] * len(cls._fields)
+        return cls.from_columns(*columns)
+
+# The kinds of array that can only hold values of a given type.
+array_dtypes = {'q': int, 'l': int, 'i': int, 'h': int, 'b': int,
+                'd': float, 'f': float}
+
+def check_column(constraint, column):
+    """Check 'constraint' against every value in 'column'."""
+    if type(constraint) is Anything:
+        return
+    if type(constraint) is Require:
+        if (isinstance(column, array) and
+            issubclass(array_dtypes.get(column.typecode, object),
+                       constraint.dtype)):
+            return
+        # Check each distinct type of value rather than each value.
+        for valuetype in set(map(type, column)):
+            if not issubclass(valuetype, (constraint.dtype, Binding)):
+                raise TypeError("expected type %s, got %s" %
+                                (constraint.dtype, valuetype))
+        return
+    for value in column:
+        if not isinstance(value, Binding):
+            constraint.check(value)
+
+def value_types(values):
+    """Return the types of 'values' and of the values in the tuples,
+    ADTs and frozensets among them, so that values that are equal
+    but hold e.g. 1, 1.0 or True somewhere can be told apart. Shared
+    interned instances are distinct for values of distinct types, so
+    their identity stands for them.
+    """
+    types = []
+    stack = list(values)
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Interned) and '_hash' in item.__dict__:
+            types.append(id(item))
+        else:
+            types.append(type(item))
+            if isinstance(item, (tuple, frozenset)):
+                stack.extend(item)
+    return tuple(types)
+
+class Interned:
+    """Mix-in for variants defined with intern=True. Constructing
+    an instance equal to one that already exists returns the
+    existing instance, so equal values are identical, compare in
+    constant time and compute their hash only once.
+    """
+    def __new__(cls, *args, **kwargs):
+        instance = super().__new__(cls, *args, **kwargs)
+        # The types of the values in the fields are part of the key
+        # so that e.g. Cons(1, Nil()) and Cons((1.0,), Nil()) aren't
+        # shared with Cons(1.0, Nil()) or Cons((1,), Nil()).
+        key = (tuple(instance), value_types(instance))
+        try:
+            ref = cls._interned.get(key)
+        except TypeError:
+            # Unhashable field values. This one can't be shared.
+            return instance
+        if ref is not None:
+            return ref.instance
+        # Check the instance before letting anyone else have it.
+        ADT.__init__(instance)
+        instance._hash = tuple.__hash__(instance)
+        instance._ref = cls._interned[key] = InternRef(instance)
+        return instance
+
+    def __init__(self, *args, **kwargs):
+        if '_hash' not in self.__dict__:
+            # Not shared, so it hasn't been checked yet.
+            ADT.__init__(self)
+
+    @classmethod
+    def _make(cls, iterable):
+        return cls(*iterable)
+
+    def __hash__(self):
+        try:
+            return self.__dict__['_hash']
+        except KeyError:
+            return tuple.__hash__(self)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if (type(other) is type(self) and '_hash' in self.__dict__
+            and '_hash' in other.__dict__
+            and value_types(self) == value_types(other)):
+            # Both are shared and hold values of the same types, so
+            # they would be identical if they were equal.
+            return False
+        # Otherwise compare them like any other tuples, so that e.g.
+        # an instance holding 1 equals one holding 1.0.
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+class InternRef:
+    """The entry for an interned instance in its class's table.
+    Tuples can't be weakly referenced, so the table holds these
+    weakly instead. An instance and its InternRef refer to each
+    other, and the entry goes away when the garbage collector
+    reclaims the pair.
+    """
+    __slots__ = ('instance', '__weakref__')
+
+    def __init__(self, instance):
+        self.instance = instance
+
+class VariantColumns:
+    """A compact container for many instances of one variant that
+    stores each field in its own column: an array for fields
+    declared as Require(int) or Require(float) and a list for the
+    others. Indexing hands out lightweight ColumnView objects
+    rather than instances. (The array columns support the buffer
+    protocol, so they can be wrapped with numpy.frombuffer.)
+    """
+    array_typecodes = {int: 'q', float: 'd'}
+
+    def __init__(self, variant, instances=()):
+        self.variant = variant
+        self.columns = [
+            array(self.array_typecodes[constraint.dtype])
+            if isinstance(constraint, Require)
+            and constraint.dtype in self.array_typecodes
+            else []
+            for constraint in variant._constraints]
+        self._length = 0
+        self.extend(instances)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('column index out of range')
+        return ColumnView(self, index)
+
+    def __iter__(self):
+        return (ColumnView(self, index) for index in range(self._length))
+
+    def column(self, field):
+        """Return the column holding the values of 'field'."""
+        return self.columns[self.variant._fields.index(field)]
+
+    def append(self, *args):
+        """Add an instance given the values of its fields."""
+        if len(args) != len(self.columns):
+            raise TypeError("expected %d values, got %d" %
+                            (len(self.columns), len(args)))
+        for constraint, value in zip(self.variant._constraints, args):
+            constraint.check(value)
+        for index, value in enumerate(args):
+            column = self.columns[index]
+            if isinstance(column, array) and type(value) not in (int, float):
+                # Subclasses such as bool wouldn't survive the
+                # round trip through an array.
+                column = self.columns[index] = list(column)
+            try:
+                column.append(value)
+            except OverflowError:
+                column = self.columns[index] = list(column)
+                column.append(value)
+        self._length += 1
+
+    def extend(self, instances):
+        """Add each of the given instances of the variant."""
+        for instance in instances:
+            if not isinstance(instance, self.variant):
+                raise TypeError("expected %s, got %s" %
+                                (self.variant, instance.__class__))
+            self.append(*instance)
+
+    def instance(self, index):
+        """Return the instance stored at 'index'."""
+        return self.variant(*(column[index] for column in self.columns))
+
+class ColumnView:
+    """A reference to one instance in a VariantColumns, with its
+    fields available as attributes or by position.
+    """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    @property
+    def _fields(self):
+        return self._table.variant._fields
+
+    def __getattr__(self, field):
+        try:
+            return self._table.column(field)[self._index]
+        except ValueError:
+            raise AttributeError(field) from None
+
+    def __getitem__(self, position):
+        return self._table.columns[position][self._index]
+
+    def __len__(self):
+        return len(self._table.columns)
+
+    def __iter__(self):
+        return (column[self._index] for column in self._table.columns)
+
+    def __repr__(self):
+        return '<view of %r>' % (self._table.instance(self._index),)
+
+    def materialize(self):
+        """Return the instance that this view refers to."""
+        return self._table.instance(self._index)
+
+def digest(value):
+    """Return a digest of the structure of the ADT instance 'value':
+    a hash of its variant and of the digests of its fields, so equal
+    values have equal digests whatever their identity. Instances
+    with a __dict__ (variants defined with slots=False or intern=True)
+    remember their digest, so it is computed once per instance and a
+    value derived from one with _replace only computes the digests
+    of the nodes that are new. Tuples, lists, sets, frozensets and
+    dicts in fields are digested by their elements, in order for
+    tuples and lists, and other field values by type and value, or
+    by their pickle if they aren't simple.
+    """
+    found = cached_digest(value)
+    if found is not None:
+        return found
+    # Digests of the nodes computed so far, by id, and the ids of
+    # the nodes whose children have been pushed.
+    digests = {}
+    started = set()
+    stack = [value]
+    while stack:
+        node = stack[-1]
+        children = digest_children(node)
+        pending = [child for child in children
+                   if id(child) not in digests and is_node(child)
+                   and cached_digest(child) is None]
+        if pending:
+            if any(id(child) in started for child in pending):
+                raise ValueError("can't digest a value that contains itself")
+            started.add(id(node))
+            stack.extend(pending)
+            continue
+        stack.pop()
+        parts = []
+        for child in children:
+            if is_node(child):
+                parts.append(b'n' + (cached_digest(child) or
+                                     digests[id(child)]))
+            else:
+                data = leaf_bytes(child)
+                parts.append(b'%d:' % len(data) + data)
+        nodetype = type(node)
+        header = container_headers.get(nodetype)
+        if header is None:
+            # Views of encoded values (see adtcodec) digest as their variant.
+            variant = getattr(nodetype, '_variant', nodetype)
+            header = ('%s.%s' % (variant.__module__,
+                                 variant.__qualname__)).encode()
+        elif header == b'S':
+            # Sets are digested the same whatever their order.
+            parts.sort()
+        elif header == b'D':
+            parts = sorted(map(bytes.__add__, parts[::2], parts[1::2]))
+        node_digest = digests[id(node)] = hashlib.blake2b(
+            header + b''.join(parts), digest_size=20).digest()
+        if nodetype.__dictoffset__:
+            node.__dict__['_digest'] = node_digest
+    return digests[id(value)]
+
+# The headers of the digests of the containers digested by element.
+container_headers = {tuple: b'T', list: b'L', set: b'S', frozenset: b'S',
+                     dict: b'D'}
+
+def is_node(value):
+    """Return whether 'value' is digested by its children."""
+    return isinstance(value, ADT) or type(value) in container_headers
+
+def digest_children(node):
+    """Return the fields of an ADT instance or the elements of a
+    container, with the keys and values of a dict alternating.
+    """
+    if type(node) is dict:
+        return list(chain.from_iterable(node.items()))
+    return list(node)
+
+def cached_digest(value):
+    if type(value).__dictoffset__:
+        return value.__dict__.get('_digest')
+    return None
+
+def leaf_bytes(value):
+    """Return the bytes to digest for a field value that isn't an ADT."""
+    valuetype = type(value)
+    if valuetype is str:
+        return b's' + value.encode('utf-8', 'surrogatepass')
+    if valuetype is bytes:
+        return b'b' + value
+    if valuetype in (int, float, bool, type(None)):
+        return ('%s %r' % (valuetype.__name__, value)).encode()
+    return b'p' + pickle.dumps(value, 4)
+
+def equal(a, b):
+    """Compare two ADT instances by their digests, which takes
+    constant time once they are known. Unlike ==, values whose
+    fields are equal but of different types (like 1 and 1.0) or
+    whose variants differ are not equal.
+    """
+    return a is b or digest(a) == digest(b)
+
+class Zipper:
+    """A position in an ADT value, from which the value can be
+    rebuilt with the subtree at that position replaced. Moving up
+    copies a node only if something below it was replaced, and
+    the copy shares all of its other fields with the original, so
+    only new field values have their constraints checked. For
+    example, this returns 'lst' with its second element replaced:
+
+        Zipper(lst).down('cdr').down('car').replace(0).root()
+    """
+    __slots__ = ('focus', '_path')
+
+    def __init__(self, focus, _path=None):
+        self.focus = focus
+        # The path is a linked list of (parent, index, replaced, path)
+        # tuples, where 'replaced' is whether anything below the
+        # parent was replaced.
+        self._path = _path
+
+    def __repr__(self):
+        return '<Zipper at %r>' % (self.focus,)
+
+    def down(self, field):
+        """Move to the field of the focus with the given name or
+        position.
+        """
+        node = self.focus
+        if not isinstance(node, ADT):
+            raise TypeError("can't move into %r" % (node,))
+        if isinstance(field, int):
+            index = field
+        elif field in node._fields:
+            index = node._fields.index(field)
+        else:
+            raise AttributeError("%s has no field %r" %
+                                 (type(node).__name__, field))
+        return Zipper(node[index], (node, index, False, self._path))
+
+    def up(self):
+        """Move to the parent of the focus."""
+        if self._path is None:
+            raise ValueError("already at the root")
+        parent, index, replaced, path = self._path
+        if not replaced:
+            return Zipper(parent, path)
+        fields = list(parent)
+        fields[index] = self.focus
+        if path is not None:
+            path = path[:2] + (True, path[3])
+        return Zipper(rebuild(parent, fields), path)
+
+    def replace(self, value):
+        """Replace the focus with 'value', which is checked against
+        the constraint of the field it goes in unless its variant was
+        defined with check=False.
+        """
+        if self._path is None:
+            return Zipper(value)
+        parent, index, replaced, path = self._path
+        if (parent._check and checking.enabled
+            and not isinstance(value, Binding)):
+            parent._constraints[index].check(value)
+        return Zipper(value, (parent, index, True, path))
+
+    def update(self, func):
+        """Replace the focus with the result of calling 'func' on it."""
+        return self.replace(func(self.focus))
+
+    def root(self):
+        """Return the whole value with the replacements made."""
+        zipper = self
+        while zipper._path is not None:
+            zipper = zipper.up()
+        return zipper.focus
+
+def rebuild(node, fields):
+    """Return a copy of 'node' with the given fields, without
+    checking them. (Interned variants are constructed as usual, so
+    that the copy can be shared.)
+    """
+    variant = getattr(type(node), '_variant', type(node))
+    if issubclass(variant, Interned):
+        return variant(*fields)
+    return tuple.__new__(variant, fields)
+
+def set_in(value, path, new):
+    """Return 'value' with the subtree found by following 'path', a
+    sequence of field names or positions, replaced by 'new'.
+    """
+    return edit(value, [(path, new)])
+
+def update_in(value, path, func):
+    """Return 'value' with the subtree found by following 'path'
+    replaced by the result of calling 'func' on it.
+    """
+    zipper = Zipper(value)
+    for field in path:
+        zipper = zipper.down(field)
+    return zipper.update(func).root()
+
+def edit(value, edits):
+    """Return 'value' with each (path, new) pair in 'edits' applied
+    in turn, as by set_in. Edits that share a prefix of their paths
+    share the work of moving along it, and each node is copied at
+    most once per edit below it.
+    """
+    zipper = Zipper(value)
+    steps = []
+    for path, new in edits:
+        path = list(path)
+        common = 0
+        while (common < len(steps) and common < len(path)
+               and steps[common] == path[common]):
+            common += 1
+        for __ in range(len(steps) - common):
+            zipper = zipper.up()
+        for field in path[common:]:
+            zipper = zipper.down(field)
+        zipper = zipper.replace(new)
+        steps = path
+    return zipper.root()
+
+def fold(tree, algebra, memo=None):
+    """Reduce 'tree', an ADT or Python AST value, from the leaves
+    up. 'algebra' maps classes to functions, and each node is
+    replaced by the result of calling the function for the nearest
+    class in its MRO with the node and the results for each of its
+    fields, in order. Lists in fields are replaced by lists of the
+    results for their elements, and other field values are passed
+    as they are. For example:
+
+        fold(lst, {Cons: lambda node, car, cdr: car + cdr,
+                   Nil: lambda node: 0})
+
+    'memo' is None to process every occurrence of a node, or
+    'identity' to process nodes that are the same object only once,
+    which makes folding a tree with shared subtrees linear in the
+    number of distinct ones. 'hash' also processes nodes that are
+    equal, with fields of the same types, only once; it takes time
+    linear in the number of distinct objects in the tree.
+    """
+    def combine(node, results):
+        handler = handler_for(node)
+        if handler is None:
+            raise TypeError("no handler for %s" % type(node).__name__)
+        return handler(node, *results)
+    handler_for = handler_lookup(algebra)
+    return traverse(tree, combine, memo)
+
+def transform(tree, rules, memo=None):
+    """Rewrite 'tree', an ADT or Python AST value, from the leaves
+    up. Each node is rebuilt with the rewritten values of its fields
+    and then passed to the function in 'rules' for the nearest class
+    in its MRO, if there is one, to be replaced with its result.
+    Nodes whose fields are unchanged are kept rather than copied,
+    and only changed fields are checked against their constraints,
+    in variants that check them. 'memo' is as for fold.
+    """
+    def combine(node, results):
+        node = rebuild_changed(node, results)
+        rule = rule_for(node)
+        return node if rule is None else rule(node)
+    rule_for = handler_lookup(rules)
+    return traverse(tree, combine, memo)
+
+def handler_lookup(handlers):
+    """Return a function to find the handler in 'handlers' for a node
+    by the classes in its MRO, or None, remembering it for the node's
+    class.
+    """
+    found = {}
+    def lookup(node):
+        cls = type(node)
+        try:
+            return found[cls]
+        except KeyError:
+            pass
+        handler = found[cls] = next((handlers[base] for base in cls.__mro__
+                                     if base in handlers), None)
+        return handler
+    return lookup
+
+def node_fields(node):
+    """Return the values of the fields of an ADT or AST node."""
+    if isinstance(node, ADT):
+        return tuple(node)
+    return tuple(getattr(node, field, None) for field in node._fields)
+
+def traverse(tree, combine, memo):
+    """Call 'combine' on each node of 'tree' with the results for
+    its fields, after the nodes below it, and return the result for
+    'tree'. The tree is walked with an explicit stack.
+    """
+    if memo == 'hash':
+        return traverse_equal(tree, combine)
+    if memo is None:
+        results = None
+    elif memo == 'identity':
+        results = {}
+    else:
+        raise ValueError("memo must be None, 'identity' or 'hash'")
+    # Each entry is a value to visit, or a Visited node or list
+    # whose fields' results are at the end of 'out'.
+    stack = [tree]
+    out = []
+    while stack:
+        item = stack.pop()
+        if type(item) is Visited:
+            value, count = item
+            fields = out[len(out) - count:]
+            del out[len(out) - count:]
+            if type(value) is list:
+                result = fields
+            else:
+                result = combine(value, fields)
+                if results is not None:
+                    results[id(value)] = result
+            out.append(result)
+        elif isinstance(item, (ADT, ast.AST)):
+            if results is not None and id(item) in results:
+                out.append(results[id(item)])
+                continue
+            fields = node_fields(item)
+            stack.append(Visited(item, len(fields)))
+            stack.extend(reversed(fields))
+        elif type(item) is list:
+            stack.append(Visited(item, len(item)))
+            stack.extend(reversed(item))
+        else:
+            out.append(item)
+    return out[0]
+
+def traverse_equal(tree, combine):
+    """traverse, calling 'combine' once for each distinct value.
+    Each node and list is numbered by its type and the numbers or
+    values of its fields, so its key is hashed in time proportional
+    to its own size, and a node seen before by identity isn't walked
+    again. Python AST nodes are only equal to themselves.
+    """
+    # The result and number of each node walked, by id, the results
+    # by number, and the number of each distinct key.
+    seen = {}
+    results = []
+    numbers = {}
+    stack = [tree]
+    out = []
+    keys = []
+    while stack:
+        item = stack.pop()
+        if type(item) is Visited:
+            value, count = item
+            fields = out[len(out) - count:]
+            del out[len(out) - count:]
+            fieldkeys = tuple(keys[len(keys) - count:])
+            del keys[len(keys) - count:]
+            if isinstance(value, ast.AST) or None in fieldkeys:
+                key = None
+            else:
+                key = (type(value), fieldkeys)
+            number = numbers.get(key)
+            if number is None:
+                number = len(results)
+                if key is not None:
+                    numbers[key] = number
+                results.append(fields if type(value) is list
+                               else combine(value, fields))
+            if type(value) is list:
+                # Each list gets its own list of results, and is
+                # walked again wherever it appears.
+                result = fields
+            else:
+                result = results[number]
+                seen[id(value)] = (result, number)
+            out.append(result)
+            keys.append(number)
+        elif id(item) in seen:
+            result, number = seen[id(item)]
+            out.append(result)
+            keys.append(number)
+        elif isinstance(item, (ADT, ast.AST)):
+            fields = node_fields(item)
+            stack.append(Visited(item, len(fields)))
+            stack.extend(reversed(fields))
+        elif type(item) is list:
+            stack.append(Visited(item, len(item)))
+            stack.extend(reversed(item))
+        else:
+            out.append(item)
+            try:
+                hash(item)
+            except TypeError:
+                # Unhashable, so nodes holding it can't be remembered.
+                keys.append(None)
+            else:
+                keys.append((type(item), item))
+    return out[0]
+
+Visited = namedtuple('Visited', 'value count')
+
+def rebuild_changed(node, fields):
+    """Return 'node' with the given values for its fields, the node
+    itself if they are the same, or the lists in an AST node's
+    fields if they hold the same values.
+    """
+    old = node_fields(node)
+    changed = False
+    for index, (old_value, value) in enumerate(zip(old, fields)):
+        if value is old_value:
+            continue
+        if (type(value) is list and type(old_value) is list
+            and len(value) == len(old_value)
+            and all(map(operator.is_, value, old_value))):
+            fields[index] = old_value
+            continue
+        changed = True
+        if (isinstance(node, ADT) and node._check and checking.enabled
+            and not isinstance(value, Binding)):
+            node._constraints[index].check(value)
+    if not changed:
+        return node
+    if isinstance(node, ADT):
+        return rebuild(node, fields)
+    return ast.copy_location(
+        type(node)(**dict(zip(node._fields, fields))), node)
+
 class Binding(str):
     """A Python identifier that can be inserted into a data structure
     pattern in order to bind matching values to the given name.
@@ -122,44 +891,183 @@ class BindingRest(Binding):
     """
     pass
 
-class MatchFailed(Exception):
+class ExactKeys(OrderedDict):
+    """A mapping pattern that only matches mappings with exactly
+    its keys, where a plain mapping pattern matches mappings with
+    any other keys as well. Its values are captured in the order
+    its keys are given.
+    """
     pass
 
+class MatchFailed(Exception):
+    """Raised when a value doesn't match a pattern.
+
+    The message is given as a format string and its arguments
+    and only formatted when it is asked for, since most failures
+    (e.g. while trying the cases of a MatchCases) are discarded
+    and the values involved can be arbitrarily large.
+    """
+    def __str__(self):
+        message, *args = self.args or ('',)
+        return message % tuple(args) if args else str(message)
+
+# The type of compiled regular expressions. (re._pattern_type
+# is not available in newer versions of Python.)
+regex_type = type(re.compile(''))
+
+@lru_cache(maxsize=256)
+def regex_groups(pattern):
+    """Return the names of the named groups of the compiled regular
+    expression 'pattern' in the order they appear in it.
+    """
+    return tuple(sorted(pattern.groupindex, key=pattern.groupindex.get))
+
+def match_regex(pattern, value):
+    """Return the match of the compiled regular expression 'pattern'
+    at the start of 'value', which is a str for an expression for
+    str and any bytes-like object (bytes, bytearray, memoryview,
+    mmap) for one for bytes. Raises MatchFailed if it doesn't match
+    or is of the wrong type.
+    """
+    try:
+        match = pattern.match(value)
+    except TypeError:
+        raise MatchFailed("regex %r can't match %r",
+                          pattern.pattern, value) from None
+    if match is None:
+        raise MatchFailed("regex %r didn't match %r", pattern.pattern, value)
+    return match
+
+def mapping_layout(map):
+    """Return the keys of the mapping pattern 'map' in the order
+    their values are matched, which is that of an ordered dictionary
+    and otherwise sorted, and as a frozenset.
+    """
+    if isinstance(map, OrderedDict):
+        keys = list(map.keys())
+    else:
+        keys = sorted(map.keys())
+    return keys, frozenset(keys)
+
+def check_mapping(value, keys, required, exact):
+    """Check that 'value' is a mapping with all of 'keys' (the
+    frozenset 'required'), and no others if 'exact', so that its
+    values for them can be looked up without checking each one.
+    """
+    if type(value) is not dict and not (hasattr(value, 'keys') and
+                                        hasattr(value, 'values')):
+        # value is not a mapping type.
+        raise MatchFailed("can't match mapping type pattern "
+                          "with %r", value)
+    try:
+        complete = value.keys() >= required
+    except TypeError:
+        # The keys aren't a set-like view.
+        complete = all(key in value for key in required)
+    if not complete:
+        missing = next(key for key in keys if key not in value)
+        raise MatchFailed("pattern has key %r "
+                          "which is not in value", missing)
+    if exact and len(value) != len(required):
+        raise MatchFailed("value %r has keys that are not in the pattern",
+                          value)
+
+def mapping_values(value, keys, required, exact):
+    """Return the values of the mapping 'value' for 'keys' after
+    checking it with check_mapping.
+    """
+    check_mapping(value, keys, required, exact)
+    return [value[key] for key in keys]
+
+def group_values(match, groups):
+    """Return the values of the named 'groups' of 'match' as a tuple."""
+    if len(groups) == 1:
+        return (match.group(groups[0]),)
+    if groups:
+        return match.group(*groups)
+    return ()
+
 def dispatch(pattern, handle):
     """Dispatches to the appropriate method of 'handle' based
     on the type of 'pattern'.
     """
-    if isinstance(pattern, Binding):
-        return handle.binding(pattern)
+    try:
+        kind = _pattern_kinds[type(pattern)]
+    except KeyError:
+        kind = _pattern_kinds[type(pattern)] = classify_type(type(pattern))
+    if kind is None:
+        # The pattern is a class. Those are classified individually.
+        try:
+            kind = _class_pattern_kinds[pattern]
+        except KeyError:
+            kind = _class_pattern_kinds[pattern] = classify_class(pattern)
+    return getattr(handle, kind)(pattern)
+
+# Caches of the pattern kinds found by classify_type and
+# classify_class, and the kinds registered for particular
+# types by register_pattern_kind.
+_pattern_kinds = {}
+_class_pattern_kinds = {}
+_registered_kinds = {}
+
+def register_pattern_kind(cls, kind):
+    """Make instances of 'cls' (and its subclasses) dispatch to
+    the method named 'kind' of the handler, e.g. 'mapping' or
+    'sequence', instead of the one they would otherwise get. A
+    new kind requires the handlers that will see such patterns
+    (PatternCompiler, BindingExtractor, ...) to have a method of
+    that name.
+    """
+    _registered_kinds[cls] = kind
+    _pattern_kinds.clear()
 
-    if isinstance(pattern, type) and issubclass(pattern, ADT):
-        if not hasattr(pattern, '_fields'):
-            raise TypeError("can't match against generic type %r" %
-                            pattern)
-        return handle.adt_constructor(pattern)
+def classify_type(cls):
+    """Return the name of the handler method for patterns that
+    are instances of 'cls', or None if they are classes.
+    """
+    if issubclass(cls, type):
+        return None
 
-    if isinstance(pattern, ADT):
-        return handle.adt_instance(pattern)
+    for base in cls.__mro__:
+        if base in _registered_kinds:
+            return _registered_kinds[base]
 
-    if isinstance(pattern, type) and issubclass(pattern, ast.AST):
-        return handle.ast_constructor(pattern)
+    if issubclass(cls, Binding):
+        return 'binding'
 
-    if isinstance(pattern, ast.AST):
-        return handle.ast_instance(pattern)
+    if issubclass(cls, ADT):
+        return 'adt_instance'
 
-    if isinstance(pattern, re._pattern_type):
-        return handle.regexp(pattern)
+    if issubclass(cls, ast.AST):
+        return 'ast_instance'
 
-    if isinstance(pattern, str):
-        return handle.literal(pattern)
+    if issubclass(cls, regex_type):
+        return 'regexp'
 
-    if hasattr(pattern, 'keys') and hasattr(pattern, 'values'):
-        return handle.mapping(pattern)
+    if issubclass(cls, str):
+        return 'literal'
 
-    if hasattr(pattern, '__iter__'):
-        return handle.sequence(pattern)
+    if hasattr(cls, 'keys') and hasattr(cls, 'values'):
+        return 'mapping'
 
-    return handle.literal(pattern)
+    if hasattr(cls, '__iter__'):
+        return 'sequence'
+
+    return 'literal'
+
+def classify_class(pattern):
+    """Return the name of the handler method for the class 'pattern'."""
+    if issubclass(pattern, ADT):
+        if not hasattr(pattern, '_fields'):
+            raise TypeError("can't match against generic type %r" %
+                            pattern)
+        return 'adt_constructor'
+
+    if issubclass(pattern, ast.AST):
+        return 'ast_constructor'
+
+    # Other classes are compared like any other value.
+    return 'literal'
 
 def extract_bindings(pattern):
     """Return an iterable of all the bindings contained in 'pattern'."""
@@ -169,9 +1077,6 @@ class BindingExtractor(Singleton):
     """Provides a set of methods for each type of (sub)pattern for
     extracting all the bindings that it contains.
     """
-    # Matches named groups in Python regular expression strings.
-    named_group_re = re.compile(r'\(\?P<([^>]+)>')
-
     def binding(self, binding):
         if binding != '':
             # Bindings with an empty string identifier
@@ -198,7 +1103,7 @@ class BindingExtractor(Singleton):
 
     def regexp(self, pattern):
         # A regular expression in a pattern binds all of its named groups.
-        return self.named_group_re.findall(pattern.pattern)
+        return regex_groups(pattern)
 
     def mapping(self, map):
         # Check for bindings in the elements of the mapping type.
@@ -226,10 +1131,38 @@ def match(pattern, value):
     from the bindings in the pattern containing the
     associated values from the given value. If the match
     fails, MatchFailed is raised.
+
+    """
+    return cached_compile(pattern).match(value)
+
+def match_iter(pattern, values, on_failure='skip'):
+    """Generate the result of matching 'pattern' against each of
+    'values', which can be any iterable, including an unbounded
+    one, as soon as each value is read. 'on_failure' says what to
+    do with values that don't match: 'skip' them, 'yield' the
+    MatchFailed exception in place of a result, or 'raise' it. The
+    pattern is compiled once.
     """
-    bindings = dispatch(pattern, MatchVisitor(value))
-    fields, values = unzip(bindings)
-    return namedtuple('CapturedValues', fields)(*values)
+    if on_failure not in ('skip', 'yield', 'raise'):
+        raise ValueError("on_failure must be 'skip', 'yield' or 'raise'")
+    compiled = compile_pattern(pattern)
+    return map_results(compiled.match, values, on_failure, MatchFailed)
+
+def map_results(func, values, on_failure, failure_type):
+    """Generate 'func(value)' for each of 'values', handling
+    exceptions of 'failure_type' as 'on_failure' says. (See
+    'match_iter'.)
+    """
+    for value in values:
+        try:
+            result = func(value)
+        except failure_type as failure:
+            if on_failure == 'raise':
+                raise
+            if on_failure == 'yield':
+                yield failure
+            continue
+        yield result
 
 class MatchVisitor:
     """Provides a set of methods which when dispatched on
@@ -243,8 +1176,8 @@ class MatchVisitor:
         try:
             return dispatch(subpattern, MatchVisitor(subvalue))
         except MatchFailed as failure:
-            raise MatchFailed("%r didn't match %r" %
-                              (subvalue, subpattern)) from failure
+            raise MatchFailed("%r didn't match %r",
+                              subvalue, subpattern) from failure
 
     def binding(self, binding):
         # A binding matches any value and binds it.
@@ -254,16 +1187,16 @@ class MatchVisitor:
         # A type constructor matches any instance of its class
         # and binds its fields to the instance's values.
         if not isinstance(self.value, ctr):
-            raise MatchFailed("expected %r, got %r" %
-                              (ctr, self.value))
+            raise MatchFailed("expected %r, got %r",
+                              ctr, self.value)
         return zip(ctr._fields, self.value)
 
     def adt_instance(self, instance):
         # A type instance matches instances of the same type
         # if the values of each of their fields also match.
         if not isinstance(self.value, instance.__class__):
-            raise MatchFailed("expected %r, got %r" %
-                              (instance, self.value))
+            raise MatchFailed("expected %r, got %r",
+                              instance, self.value)
         return chain.from_iterable(
             self.recur(subpattern, subvalue)
             for subpattern, subvalue in zip(instance, self.value))
@@ -272,8 +1205,8 @@ class MatchVisitor:
         # A Python AST constructor matches instances of its class
         # and binds its fields to the instances values.
         if not isinstance(self.value, ctr):
-            raise MatchFailed("expected %r, got %r" %
-                              (ctr, self.value))
+            raise MatchFailed("expected %r, got %r",
+                              ctr, self.value)
         return ((field, getattr(self.value, field))
                 for field in ctr._fields)
 
@@ -281,8 +1214,8 @@ class MatchVisitor:
         # A Python AST instance matches instances of the same type
         # if the values of each of their fields also match.
         if not isinstance(self.value, instance.__class__):
-            raise MatchFailed("expected %r, got %r" %
-                              (instance, self.value))
+            raise MatchFailed("expected %r, got %r",
+                              instance, self.value)
         return chain.from_iterable(
             self.recur(getattr(instance, field),
                        getattr(self.value, field))
@@ -291,47 +1224,28 @@ class MatchVisitor:
     def regexp(self, pattern):
         # A regular expression matches in the usual sense and
         # binds any named groups the matched values.
-        # TODO: Should check that value is a string first?
-        match = pattern.match(self.value)
-        if match is None:
-            raise MatchFailed("regex %r didn't match %r" %
-                              (pattern.pattern, self.value))
-        items = match.groupdict().items()
+        match = match_regex(pattern, self.value)
         # Return the bindings in the order they were in RE string.
-        return sorted(items,
-                      key=lambda item: pattern.groupindex[item[0]])
+        groups = regex_groups(pattern)
+        return zip(groups, group_values(match, groups))
 
     def mapping(self, map):
         # A mapping type matches values which are also mapping types
         # if all of the keys in the pattern map are in the value map
         # and if the corresponding values match.
-        if not (hasattr(self.value, 'keys') and
-                hasattr(self.value, 'values')):
-            # value is not a mapping type.
-            raise MatchFailed("can't match mapping type pattern "
-                              "with %r" % self.value)
-        def check(key):
-            # check that value has key and that its value
-            # for that key mathes the pattern's value
-            if key not in self.value:
-                raise MatchFailed("pattern has key %r "
-                                  "which is not in value" % key)
-            return self.recur(map[key], self.value[key])
-
-        # Get the set of keys to check and sort them if they
-        # are not coming out of an ordered dictionary.
-        keys = map.keys()
-        if not isinstance(map, OrderedDict):
-            keys = sorted(map.keys())
-
-        return chain.from_iterable(check(key) for key in keys)
+        keys, required = mapping_layout(map)
+        subvalues = mapping_values(self.value, keys, required,
+                                   isinstance(map, ExactKeys))
+        return chain.from_iterable(
+            self.recur(map[key], subvalue)
+            for key, subvalue in zip(keys, subvalues))
 
     def sequence(self, seq):
         # A sequence pattern matches sequence values if each
         # of the elements match.
         if not hasattr(self.value, '__iter__'):
             # value is not a sequence type.
-            raise MatchFailed("can't match sequence with %r" %
+            raise MatchFailed("can't match sequence with %r",
                               self.value)
 
         sentinel = object() # signals the end of either sequence
@@ -367,13 +1281,555 @@ class MatchVisitor:
         # Anything else in the pattern matches if it is
         # equal to the value and results in no binding.
         if self.value != value:
-            raise MatchFailed("%r didn't match %r" %
-                              (self.value, value))
+            raise MatchFailed("%r didn't match %r",
+                              self.value, value)
         return ()
 
-class CasesExhausted(Exception):
+class CompiledPattern:
+    """A pattern that has been analyzed ahead of time so that it
+    can be matched against many values without dispatching on
+    the type of each of its elements again.
+    """
+    def __init__(self, pattern, matcher, fields):
+        self.pattern = pattern
+        self.fields = tuple(fields)
+        self._matcher = matcher
+        self._captured = captured_values_type(self.fields)
+        # The class that any matching value must be an instance
+        # of, or None if the pattern doesn't require one.
+        self.guard = getattr(matcher, 'guard', None)
+        self._unguarded = getattr(matcher, 'unguarded', matcher)
+
+    def __repr__(self):
+        return 'compile_pattern(%r)' % (self.pattern,)
+
+    def match(self, value):
+        """Like 'match(self.pattern, value)'."""
+        values = []
+        self._matcher(value, values)
+        return self._captured._make(values)
+
+    def match_unguarded(self, value):
+        """Like 'match', for a value already known to be an
+        instance of 'self.guard'.
+        """
+        values = []
+        self._unguarded(value, values)
+        return self._captured._make(values)
+
+@lru_cache(maxsize=256)
+def captured_values_type(fields):
+    """Return the namedtuple class used for the results of matches
+    binding 'fields', a tuple of names. Classes are shared between
+    patterns with the same bindings; 'captured_values_type.cache_info()'
+    reports how often an existing class was reused.
+    """
+    return namedtuple('CapturedValues', fields)
+
+def compile_pattern(pattern):
+    """Analyze 'pattern' once and return a CompiledPattern whose
+    match method behaves like 'match(pattern, value)'.
+    """
+    try:
+        return PatternCompiler().compile(pattern)
+    except PatternTooDeep:
+        return compile_iterative(pattern)
+
+# Compiled patterns for match(), keyed by the id of the pattern.
+# The pattern is stored along with its parts (see pattern_parts)
+# and its compiled form to keep the id from being reused while the
+# entry is in the cache.
+_compiled_cache = OrderedDict()
+_MAXCACHE = 512
+
+def cached_compile(pattern):
+    """Return a CompiledPattern for 'pattern', reusing a previous
+    compilation of the same pattern object if it hasn't been
+    changed in the meantime.
+    """
+    try:
+        cached_pattern, parts, compiled = _compiled_cache[id(pattern)]
+        if cached_pattern is pattern and (parts is None or
+                                          same_parts(parts, pattern)):
+            return compiled
+    except KeyError:
+        pass
+    parts = pattern_parts(pattern)
+    compiled = compile_pattern(pattern)
+    if parts is not False:
+        if len(_compiled_cache) >= _MAXCACHE:
+            _compiled_cache.popitem(last=False)
+        _compiled_cache[id(pattern)] = (pattern, parts, compiled)
+    return compiled
+
+# Sequence patterns that can't be changed in place.
+immutable_sequences = (tuple, str, bytes, range, frozenset)
+
+def pattern_parts(pattern):
+    """Return the parts of 'pattern' that can be changed in place,
+    like lists, dicts and AST nodes, each with its current contents,
+    so that same_parts can tell later whether it has been changed.
+    Returns None if there are no such parts, and False for patterns
+    of kinds that it doesn't know or that hold iterators, which can
+    only be compiled once and so aren't cached.
+    """
+    parts = []
+    stack = [pattern]
+    while stack:
+        part = stack.pop()
+        kind = pattern_kind(part)
+        if kind in leaf_kinds:
+            continue
+        if kind == 'adt_instance':
+            stack.extend(part)
+            continue
+        if kind == 'sequence':
+            if iter(part) is part:
+                return False
+            contents = tuple(part)
+            if not isinstance(part, immutable_sequences):
+                parts.append((part, kind, contents))
+        elif kind in part_contents:
+            contents = part_contents[kind](part)
+            parts.append((part, kind, contents))
+        else:
+            return False
+        stack.extend(contents)
+    return parts or None
+
+# Kinds of patterns without subpatterns.
+leaf_kinds = {'binding', 'adt_constructor', 'ast_constructor', 'regexp',
+              'literal'}
+
+# Functions returning the subpatterns of changeable patterns (and the
+# keys of mappings) by kind.
+part_contents = {
+    'sequence': tuple,
+    'mapping': lambda map: tuple(map.keys()) + tuple(map.values()),
+    'ast_instance': lambda node: tuple(node.__dict__.values()),
+}
+
+def same_parts(parts, pattern):
+    """Return whether the changeable parts returned by pattern_parts
+    still have the same contents.
+    """
+    for part, kind, contents in parts:
+        current = part_contents[kind](part)
+        if len(current) != len(contents) or not all(
+                map(operator.is_, current, contents)):
+            return False
+    return True
+
+class PatternCompiler:
+    """Provides a set of methods which when dispatched on a
+    pattern return a matcher function for it. A matcher is
+    called with a value and a list and appends the values
+    of the pattern's bindings to the list, or raises
+    MatchFailed. The names of those bindings are collected
+    in 'fields' in the same order.
+    """
+    # Matchers call the matchers of their subpatterns, so patterns
+    # nested deeper than this are left to compile_iterative.
+    max_depth = 100
+
+    def __init__(self):
+        self.fields = []
+        self.depth = 0
+
+    def compile(self, pattern):
+        matcher = dispatch(pattern, self)
+        return CompiledPattern(pattern, matcher, self.fields)
+
+    def recur(self, subpattern):
+        self.depth += 1
+        if self.depth > self.max_depth:
+            raise PatternTooDeep()
+        try:
+            return dispatch(subpattern, self)
+        finally:
+            self.depth -= 1
+
+    def binding(self, binding):
+        # A binding matches any value and binds it.
+        if binding == '':
+            return match_anything
+        self.fields.append(str(binding))
+        def match_binding(value, values):
+            values.append(value)
+        return match_binding
+
+    def adt_constructor(self, ctr):
+        # A type constructor matches any instance of its class
+        # and binds its fields to the instance's values.
+        self.fields.extend(ctr._fields)
+        def match_adt_fields(value, values):
+            values.extend(value)
+        return guarded(ctr, ctr, match_adt_fields)
+
+    def adt_instance(self, instance):
+        # A type instance matches instances of the same type
+        # if the values of each of their fields also match.
+        submatchers = [(self.recur(subpattern), subpattern)
+                       for subpattern in instance]
+        def match_adt_fields(value, values):
+            for (submatcher, subpattern), subvalue in zip(submatchers,
+                                                          value):
+                try:
+                    submatcher(subvalue, values)
+                except MatchFailed as failure:
+                    raise MatchFailed("%r didn't match %r",
+                                      subvalue, subpattern) from failure
+        return guarded(instance.__class__, instance, match_adt_fields)
+
+    def ast_constructor(self, ctr):
+        # A Python AST constructor matches instances of its class
+        # and binds its fields to the instances values.
+        fields = ctr._fields
+        self.fields.extend(fields)
+        def match_ast_fields(value, values):
+            values.extend(getattr(value, field) for field in fields)
+        return guarded(ctr, ctr, match_ast_fields)
+
+    def ast_instance(self, instance):
+        # A Python AST instance matches instances of the same type
+        # if the values of each of their fields also match.
+        submatchers = [(field, self.recur(subpattern), subpattern)
+                       for field in instance._fields
+                       for subpattern in [ getattr(instance, field) ]]
+        def match_ast_fields(value, values):
+            for field, submatcher, subpattern in submatchers:
+                subvalue = getattr(value, field)
+                try:
+                    submatcher(subvalue, values)
+                except MatchFailed as failure:
+                    raise MatchFailed("%r didn't match %r",
+                                      subvalue, subpattern) from failure
+        return guarded(instance.__class__, instance, match_ast_fields)
+
+    def regexp(self, pattern):
+        # A regular expression matches in the usual sense and
+        # binds any named groups the matched values, in the
+        # order they appear in the RE string. Expressions for str
+        # only match str values; those for bytes match any bytes-like
+        # value, such as a memoryview of a buffer, without decoding it.
+        groups = regex_groups(pattern)
+        self.fields.extend(groups)
+        def match_regexp(value, values):
+            try:
+                match = pattern.match(value)
+            except TypeError:
+                raise MatchFailed("regex %r can't match %r",
+                                  pattern.pattern, value) from None
+            if match is None:
+                raise MatchFailed("regex %r didn't match %r",
+                                  pattern.pattern, value)
+            if len(groups) == 1:
+                values.append(match.group(groups[0]))
+            elif groups:
+                values.extend(match.group(*groups))
+        if isinstance(pattern.pattern, str):
+            return guarded(str, pattern, match_regexp)
+        return match_regexp
+
+    def mapping(self, map):
+        # A mapping type matches values which are also mapping types
+        # if all of the keys in the pattern map are in the value map
+        # and if the corresponding values match. The keys are put in
+        # order and gathered into a set once, here; all of them are
+        # checked for before any of the values are matched.
+        keys, required = mapping_layout(map)
+        exact = isinstance(map, ExactKeys)
+        submatchers = [(key, self.recur(map[key]), map[key])
+                       for key in keys]
+        def match_mapping(value, values):
+            check_mapping(value, keys, required, exact)
+            for key, submatcher, subpattern in submatchers:
+                subvalue = value[key]
+                try:
+                    submatcher(subvalue, values)
+                except MatchFailed as failure:
+                    raise MatchFailed("%r didn't match %r",
+                                      subvalue, subpattern) from failure
+        return match_mapping
+
+    def sequence(self, seq):
+        # A sequence pattern matches sequence values if each
+        # of the elements match.
+        submatchers = []
+        rest = None
+        for subpattern in seq:
+            if isinstance(subpattern, BindingRest):
+                # Elements after a 'rest binding' are never examined.
+                rest = subpattern
+                if rest != '':
+                    self.fields.append(str(rest))
+                break
+            submatchers.append((self.recur(subpattern), subpattern))
+
+        def match_sequence(value, values):
+            if not hasattr(value, '__iter__'):
+                # value is not a sequence type.
+                raise MatchFailed("can't match sequence with %r",
+                                  value)
+            remaining = iter(value)
+            for submatcher, subpattern in submatchers:
+                subvalue = next(remaining, sentinel)
+                if subvalue is sentinel:
+                    raise MatchFailed(
+                        "pattern and value had different lengths")
+                try:
+                    submatcher(subvalue, values)
+                except MatchFailed as failure:
+                    raise MatchFailed("%r didn't match %r",
+                                      subvalue, subpattern) from failure
+            if rest is None:
+                if next(remaining, sentinel) is not sentinel:
+                    raise MatchFailed(
+                        "pattern and value had different lengths")
+            elif rest != '':
+                # Bind a generator that produces the remaining
+                # elements of the value sequence.
+                values.append(rest_values(remaining))
+        return match_sequence
+
+    def literal(self, value):
+        # Anything else in the pattern matches if it is
+        # equal to the value and results in no binding.
+        pattern = value
+        def match_literal(value, values):
+            if value != pattern:
+                raise MatchFailed("%r didn't match %r",
+                                  value, pattern)
+        return match_literal
+
+def guarded(cls, pattern, match_fields):
+    """Return a matcher that checks that the value is an instance
+    of 'cls' before handing it to 'match_fields'. The class and the
+    unchecked matcher are kept as attributes so that the check can
+    be shared when many patterns are tried against one value.
+    """
+    def match_instance(value, values):
+        if not isinstance(value, cls):
+            raise MatchFailed("expected %r, got %r", pattern, value)
+        match_fields(value, values)
+    if type(cls).__instancecheck__ is type.__instancecheck__:
+        # The check can only be shared if it is equivalent to
+        # testing the class of the value. (The deprecated AST
+        # classes like ast.Str, for example, are not.)
+        match_instance.guard = cls
+        match_instance.unguarded = match_fields
+    return match_instance
+
+# Signals the end of a sequence value.
+sentinel = object()
+
+def match_anything(value, values):
+    """Matcher for ignored bindings."""
+    pass
+
+class PatternTooDeep(Exception):
     pass
 
+# Operations of the instructions built by ProgramBuilder.
+(BIND, IGNORE, ADT_CONSTRUCTOR, ADT_INSTANCE, AST_CONSTRUCTOR,
+ AST_INSTANCE, REGEXP, MAPPING, SEQUENCE, LITERAL, EMIT) = range(11)
+
+def compile_iterative(pattern):
+    """Like compile_pattern, but the resulting matcher works
+    through the pattern with an explicit stack instead of
+    recursion, so there is no limit on how deeply nested the
+    pattern (and thus the part of the value it examines) can be.
+    """
+    builder = ProgramBuilder()
+    root = builder.build(pattern)
+    def match_program(value, values):
+        run_program(root, value, values)
+    return CompiledPattern(pattern, match_program, builder.fields)
+
+class ProgramBuilder:
+    """Provides a set of methods which when dispatched on a
+    pattern return an instruction for matching it: a list of the
+    operation, its argument, the instructions for the pattern's
+    subpatterns (filled in by 'build') and the subpatterns.
+    """
+    def __init__(self):
+        self.fields = []
+
+    def build(self, pattern):
+        """Return the instruction for 'pattern', with those of
+        its subpatterns filled in, without recursing.
+        """
+        root = []
+        # Subpatterns are built in order, each along with its own
+        # subpatterns, so that the bindings come out in order. A
+        # string on the stack is the name of a rest binding, which
+        # comes after the rest of its sequence.
+        stack = [(pattern, root)]
+        while stack:
+            pattern, siblings = stack.pop()
+            if isinstance(pattern, str) and siblings is None:
+                self.fields.append(pattern)
+                continue
+            instruction = dispatch(pattern, self)
+            siblings.append(instruction)
+            if instruction[0] is SEQUENCE and instruction[1]:
+                stack.append((str(instruction[1]), None))
+            stack.extend((subpattern, instruction[2])
+                         for subpattern in reversed(instruction[3]))
+        return root[0]
+
+    def binding(self, binding):
+        if binding == '':
+            return [IGNORE, None, [], ()]
+        self.fields.append(str(binding))
+        return [BIND, None, [], ()]
+
+    def adt_constructor(self, ctr):
+        self.fields.extend(ctr._fields)
+        return [ADT_CONSTRUCTOR, ctr, [], ()]
+
+    def adt_instance(self, instance):
+        return [ADT_INSTANCE, instance, [], tuple(instance)]
+
+    def ast_constructor(self, ctr):
+        self.fields.extend(ctr._fields)
+        return [AST_CONSTRUCTOR, ctr, [], ()]
+
+    def ast_instance(self, instance):
+        return [AST_INSTANCE, instance, [],
+                [getattr(instance, field) for field in instance._fields]]
+
+    def regexp(self, pattern):
+        groups = regex_groups(pattern)
+        self.fields.extend(groups)
+        return [REGEXP, (pattern, groups), [], ()]
+
+    def mapping(self, map):
+        keys, required = mapping_layout(map)
+        return [MAPPING, (keys, required, isinstance(map, ExactKeys)), [],
+                [map[key] for key in keys]]
+
+    def sequence(self, seq):
+        subpatterns = []
+        rest = None
+        for subpattern in seq:
+            if isinstance(subpattern, BindingRest):
+                rest = subpattern
+                break
+            subpatterns.append(subpattern)
+        return [SEQUENCE, rest, [], subpatterns]
+
+    def literal(self, value):
+        return [LITERAL, value, [], ()]
+
+def run_program(root, value, values):
+    """Match 'value' against the instruction 'root' built by
+    ProgramBuilder, appending the bound values to 'values'.
+    """
+    # Each entry is an instruction, the value it is to match and
+    # the pattern and value to blame if it doesn't.
+    stack = [(root, value, sentinel)]
+    pop = stack.pop
+    push = stack.extend
+    while stack:
+        instruction, value, blame = pop()
+        op, arg, subinstructions, subpatterns = instruction
+        try:
+            if op is BIND:
+                values.append(value)
+
+            elif op is IGNORE:
+                pass
+
+            elif op is EMIT:
+                values.append(arg)
+
+            elif op is ADT_CONSTRUCTOR:
+                if not isinstance(value, arg):
+                    raise MatchFailed("expected %r, got %r", arg, value)
+                values.extend(value)
+
+            elif op is ADT_INSTANCE:
+                if not isinstance(value, arg.__class__):
+                    raise MatchFailed("expected %r, got %r", arg, value)
+                push(reversed(list(zip(subinstructions, value,
+                                       subpatterns))))
+
+            elif op is AST_CONSTRUCTOR:
+                if not isinstance(value, arg):
+                    raise MatchFailed("expected %r, got %r", arg, value)
+                values.extend(getattr(value, field)
+                              for field in arg._fields)
+
+            elif op is AST_INSTANCE:
+                if not isinstance(value, arg.__class__):
+                    raise MatchFailed("expected %r, got %r", arg, value)
+                subvalues = [getattr(value, field) for field in arg._fields]
+                push(reversed(list(zip(subinstructions, subvalues,
+                                       subpatterns))))
+
+            elif op is REGEXP:
+                pattern, groups = arg
+                values.extend(group_values(match_regex(pattern, value),
+                                           groups))
+
+            elif op is MAPPING:
+                subvalues = mapping_values(value, *arg)
+                push(reversed(list(zip(subinstructions, subvalues,
+                                       subpatterns))))
+
+            elif op is SEQUENCE:
+                if not hasattr(value, '__iter__'):
+                    raise MatchFailed("can't match sequence with %r",
+                                      value)
+                remaining = iter(value)
+                subvalues = []
+                for __ in subinstructions:
+                    subvalue = next(remaining, sentinel)
+                    if subvalue is sentinel:
+                        raise MatchFailed(
+                            "pattern and value had different lengths")
+                    subvalues.append(subvalue)
+                if arg is None:
+                    if next(remaining, sentinel) is not sentinel:
+                        raise MatchFailed(
+                            "pattern and value had different lengths")
+                elif arg != '':
+                    # The rest binding comes after the others.
+                    push([([EMIT, rest_values(remaining), [], ()],
+                           None, sentinel)])
+                push(reversed(list(zip(subinstructions, subvalues,
+                                       subpatterns))))
+
+            else:
+                if value != arg:
+                    raise MatchFailed("%r didn't match %r", value, arg)
+
+        except MatchFailed as failure:
+            if blame is sentinel:
+                raise
+            raise MatchFailed("%r didn't match %r",
+                              value, blame) from failure
+
+def rest_values(remaining):
+    """Generator of the elements of a sequence value after those
+    matched by the elements of the pattern before a rest binding.
+    """
+    yield from remaining
+
+class CasesExhausted(Exception):
+    """Raised when none of the cases of a MatchCases class match a
+    value. Like MatchFailed, the message is only formatted when it
+    is asked for, so values skipped by MatchCases.map cost nothing
+    to describe.
+    """
+    __str__ = MatchFailed.__str__
+
+    def __reduce__(self):
+        # Sent between processes by parallel_map as its message,
+        # since the value or class may not be picklable.
+        return (type(self), (str(self),))
+
 def get_pattern(func):
     """Returns any annotation on the first argument of the
     function for use in pattern matching.
@@ -386,47 +1842,139 @@ def get_pattern(func):
     except KeyError:
         return None
 
-Case = namedtuple('Case', 'name action pattern')
+Case = namedtuple('Case', 'name action pattern matcher')
 
 class MatchCasesMeta(type):
     """Metaclass that leverages the class syntax to define
     a series of cases to be pattern matched.
+
+    Cases that take their bindings by name are recompiled from their
+    source with the bindings added as arguments, which means reading
+    and parsing the source of each such case when its class is
+    defined, unless the ADT_CODE_CACHE environment variable names a
+    directory to keep the compiled code in between runs.
     """
     @classmethod
-    def __prepare__(metacls, name, bases):
+    def __prepare__(metacls, name, bases, **options):
         return OrderedDict()
 
-    def __new__(metacls, clsname, bases, clsdict):
+    def __new__(metacls, clsname, bases, clsdict, memoize=False,
+                maxsize=1024):
         if bases is ():
             # Building the base class; no need to do anything.
             return type.__new__(metacls, clsname, bases, clsdict)
         # Pull list of cases out of the class definition.
-        cases = [Case(name, func, ptrn)
+        cases = [Case(name, func, ptrn, None)
                  for name, func in clsdict.items()
                  for ptrn in [ get_pattern(func) ]
                  if ptrn is not None]
         for case in cases: del clsdict[case.name]
         clsdict['_cases'] = cases
+        if memoize:
+            # Classes defined with memoize=True remember the results
+            # for the last 'maxsize' hashable values.
+            clsdict['_memo'] = CaseMemo(maxsize)
+            clsdict['__new__'] = staticmethod(memoized_cases)
         return type.__new__(metacls, clsname, bases, clsdict)
 
-    def __init__(cls, name, bases, clsdict):
+    def __init__(cls, name, bases, clsdict, **options):
         # Do this stuff in __init__ because the class needs to
         # be constructed in case there is a free variable that
         # refers to it.
         if hasattr(cls, '_cases'):
+            cls._cases = [case._replace(matcher=compile_pattern(case.pattern))
+                          for case in cls._cases]
             cls._cases = [cls.fixup_args(case) for case in cls._cases]
+            cls._case_table = {}
+            # How often each case matched, by name, if the cases
+            # have been reordered by it.
+            cls._case_hits = {}
+
+    def cases_for_type(cls, valuetype):
+        """Return the cases, in order, that could match a value of
+        type 'valuetype': those whose patterns don't require a
+        particular class and those whose required class is a base
+        of 'valuetype'. The result is remembered for next time.
+        """
+        cases = [case for case in cls._cases
+                 if case.matcher.guard is None
+                 or issubclass(valuetype, case.matcher.guard)]
+        if cls._case_hits:
+            cases = reorder_cases(cases, cls._case_hits, valuetype)
+        cases = combine_regex_cases(cases)
+        cls._case_table[valuetype] = cases
+        return cases
+
+    def reorder(cls, hits):
+        """Try the cases that match most often first. 'hits' maps
+        the names of cases to how often they matched, as returned by
+        'export_order', or to their CaseStats from a profile. A case
+        is only moved ahead of earlier cases that can't match the
+        same values, so each value still goes to the first case that
+        matches it in the order the cases were defined.
+        """
+        cls._case_hits = {name: getattr(count, 'successes', count)
+                          for name, count in hits.items()}
+        cls._case_table = {}
+
+    def export_order(cls):
+        """Return the hits the cases were last reordered by, which
+        can be saved (as JSON, for example) and passed to 'reorder'
+        when the program next starts.
+        """
+        return dict(cls._case_hits)
+
+    def learn_order(cls, calls=10000):
+        """Count how often each case matches over the next 'calls'
+        calls and then reorder the cases by the counts.
+        """
+        # The __new__ to go back to afterwards is kept too.
+        cls._learning = [calls, Counter(), cls.__dict__.get('__new__')]
+        cls.__new__ = staticmethod(learning_cases)
+
+    def cache_info(cls):
+        """Return the hits, misses and size of the results remembered
+        by a class defined with memoize=True, like the cache_info of
+        functools.lru_cache, along with the number of unhashable
+        values that were matched without it and the ratio of hits to
+        lookups.
+        """
+        memo = cls.memo()
+        lookups = memo.hits + memo.misses
+        return MemoInfo(memo.hits, memo.misses, memo.unhashable,
+                        memo.maxsize, len(memo.results),
+                        memo.hits / lookups if lookups else 0.0)
+
+    def invalidate(cls, *values):
+        """Forget the remembered results for 'values', or all of
+        them if none are given, for a class defined with
+        memoize=True. The counts of hits and misses are kept.
+        """
+        memo = cls.memo()
+        if not values:
+            memo.results.clear()
+        for value in values:
+            memo.results.pop(memo_key(value), None)
+
+    def memo(cls):
+        try:
+            return cls.__dict__['_memo']
+        except KeyError:
+            raise TypeError("%r was not defined with memoize=True" %
+                            cls) from None
 
     def fixup_args(cls, case):
         """If a case doesn't have a second argument to accept the
-        bound values from a match, its definition is altered to
-        accept arguments for each binding in the pattern.
+        bound values from a match, it is replaced by a function
+        that runs it with each binding in the pattern available
+        under its own name.
         """
         wants_args_patched_in = case.action.__code__.co_argcount == 1
         if not wants_args_patched_in:
             case.action.patch_in_args = False
             return case
 
-        args = tuple(extract_bindings(case.pattern))
+        args = case.matcher.fields
         if len(args) > 0:
             # Only need to add arguments to
             # the function if there is at least one binding.
@@ -436,47 +1984,131 @@ class MatchCasesMeta(type):
         return case
 
     def add_binding_args_to_func(cls, args, func):
-        """Alter the definition of 'func' to accept 'args'."""
+        """Return a function that takes the arguments of 'func'
+        followed by a value for each name in 'args', and runs the
+        body of 'func' with those names bound to the values. It is
+        recompiled from the source of 'func' with the names as
+        arguments, or failing that run with them added to a copy of
+        its globals.
+        """
+        newfunc = cls.recompile_with_args(args, func)
+        if newfunc is not None:
+            return newfunc
+        return cls.bind_as_globals(args, func)
+
+    def bind_as_globals(cls, args, func):
+        """Return a function that runs the code of 'func' with 'args'
+        added to a copy of its globals, for cases without source.
+        This costs a copy of the globals per call, and is refused
+        for cases that it would change the meaning of.
+        """
+        code = func.__code__
+        if (set(args) & set(code.co_varnames + code.co_cellvars +
+                            code.co_freevars) or writes_globals(code)):
+            raise TypeError("case %r needs its source to be given the "
+                            "bindings %s" % (func.__qualname__,
+                                             ', '.join(args)))
+        env = func.__globals__
+        name = func.__name__
+        defaults = func.__defaults__
+        kwdefaults = func.__kwdefaults__
+        closure = func.__closure__
+        nargs = code.co_argcount
+        def with_bindings(*values):
+            funcenv = env.copy()
+            funcenv.update(zip(args, values[nargs:]))
+            bound = FunctionType(code, funcenv, name, defaults, closure)
+            bound.__kwdefaults__ = kwdefaults
+            return bound(*values[:nargs])
+        with_bindings.__name__ = name
+        with_bindings.__qualname__ = func.__qualname__
+        with_bindings.__doc__ = func.__doc__
+        return with_bindings
+
+    # A directory for caching the code generated by recompile_with_args
+    # (from the ADT_CODE_CACHE environment variable), or None.
+    code_cache = os.environ.get('ADT_CODE_CACHE')
+
+    def recompile_with_args(cls, args, func):
+        """Recompile 'func' from its source with 'args' added to
+        its arguments, or return None if its source isn't available.
+        If 'code_cache' is set, the result is saved there, keyed by a
+        hash of the code of 'func', and later loaded from there
+        instead.
+        """
+        key = hashlib.sha256(marshal.dumps(func.__code__) +
+                             repr(tuple(args)).encode()).hexdigest()
+        path = None
+        if cls.code_cache is not None:
+            path = os.path.join(cls.code_cache, '%s.%s' %
+                                (key, sys.implementation.cache_tag))
+        try:
+            with open(path, 'rb') as cached:
+                code = marshal.load(cached)
+        except (TypeError, OSError, ValueError, EOFError):
+            code = cls.compile_with_args(args, func)
+            if code is None:
+                return None
+            if path is not None:
+                try:
+                    os.makedirs(cls.code_cache, exist_ok=True)
+                    with open(path, 'wb') as cached:
+                        marshal.dump(code, cached)
+                except OSError:
+                    pass
+        # Share the cells of the original closure, which might not
+        # be filled in yet (e.g. one referring to this class).
+        cells = dict(zip(func.__code__.co_freevars, func.__closure__ or ()))
+        recompiled = FunctionType(code, func.__globals__, func.__name__,
+                                  func.__defaults__,
+                                  tuple(cells[var]
+                                        for var in code.co_freevars))
+        recompiled.__kwdefaults__ = func.__kwdefaults__
+        recompiled.__doc__ = func.__doc__
+        return recompiled
+
+    def compile_with_args(cls, args, func):
+        """Return the code of 'func' with 'args' added to its
+        arguments, compiled from the source of 'func', or None if
+        the source isn't available.
+        """
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            return None
         # Get the AST of the function and add extra argument nodes.
-        funcast = ast.parse(inspect.getsource(func).strip())
-        funcname = funcast.body[0].name
-        funcargs = funcast.body[0].args
+        funcast = ast.parse(textwrap.dedent(source)).body[0]
+        # Keep the line numbers of the source file for tracebacks.
+        ast.increment_lineno(funcast, func.__code__.co_firstlineno - 1)
+        funcast.decorator_list = []
+        funcargs = funcast.args
         funcargs.args = [ ast.arg(funcargs.args[0].arg, None) ]
         funcargs.args.extend(ast.arg(str(a), None) for a in args)
-        env = dict()  # An environment in which to evaluate the modded AST.
-        if len(func.__code__.co_freevars) < 1:
-            # If the function doesn't close over any free variables,
-            # it can be evaluated as is.
-            exec(compile(funcast, '<generated>', 'exec'),
-                 func.__globals__, env)
-            newfunc = env[funcname]
-        else:
-            # TODO: what happens if a freevar is also a binding arg?
-            # Have to build a closure.
-            clsname = cls.__name__
-            freevars = tuple(func.__code__.co_freevars)
-            # Pull the values out of the existing closure.
-            # When a function is defined in a class and refers to
-            # to the class as a free variable it is not included
-            # in the closure and has to be added manually.
-            closvals = [cell.cell_contents if var != clsname else cls
-                        for var, cell in
-                        zip(freevars, func.__closure__)]
-            # Create a wrapper function to bind the closure values.
-            wrapperargs = ', '.join(freevars)
-            wrapper = ast.parse("def wrapper(%s):\n"
-                                "  def %s(): pass\n"
-                                "  return %s" %
-                                (wrapperargs, funcname, funcname))
-            wrapperfunc = wrapper.body[0]
-            # Replace the body of the wrapper with the target function.
-            wrapperfunc.body[0] = funcast.body[0]
-            # Evaluate the resulting AST and call the
-            # wrapper function with the closure values.
-            exec(compile(wrapper, '<generated>', 'exec'),
-                 func.__globals__, env)
-            newfunc = env['wrapper'](*closvals)
-        return newfunc
+        # Define it inside a function that has the original free
+        # variables as locals, so that they are compiled as such.
+        freevars = func.__code__.co_freevars
+        wrapper = ast.parse("def wrapper():\n" +
+                            "".join("  %s = None\n" % var
+                                    for var in freevars) +
+                            "  def inner(): pass\n")
+        wrapper.body[0].body[-1] = funcast
+        ast.fix_missing_locations(wrapper)
+        module = compile(wrapper, func.__code__.co_filename, 'exec')
+        wrappercode = next(const for const in module.co_consts
+                           if isinstance(const, CodeType))
+        return next(const for const in wrappercode.co_consts
+                    if isinstance(const, CodeType)
+                    and const.co_name == funcast.name)
+
+def writes_globals(code):
+    """Return whether 'code', or code nested in it, assigns to or
+    deletes global variables.
+    """
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in ('STORE_GLOBAL', 'DELETE_GLOBAL'):
+            return True
+    return any(writes_globals(const) for const in code.co_consts
+               if isinstance(const, CodeType))
 
 class MatchCases(metaclass=MatchCasesMeta):
     """Base class for building a series of cases
@@ -487,20 +2119,598 @@ class MatchCases(metaclass=MatchCasesMeta):
         # matching an return the result instead
         # of constructing an instance. Not sure
         # this the best idea.
-        for name, action, pattern in cls._cases:
+        try:
+            cases = cls._case_table[type(value)]
+        except KeyError:
+            cases = cls.cases_for_type(type(value))
+        # Cases whose pattern requires a class were selected by
+        # the type of the value, so that check can be skipped.
+        for name, action, pattern, matcher in cases:
             try:
-                bindings = match(pattern, value)
+                bindings = matcher.match_unguarded(value)
                 break
             except MatchFailed:
                 pass
         else:
-            raise CasesExhausted('no case for %r in %r' %
-                                 (value, cls))
+            raise CasesExhausted('no case for %r in %r', value, cls)
+
+        if action.patch_in_args:
+            return action(value, *bindings)
+        else:
+            return action(value, bindings)
+
+    @classmethod
+    def map(cls, values, on_failure='skip'):
+        """Generate the result of matching each of 'values' against
+        the cases, like 'match_iter'. The failures that 'on_failure'
+        refers to are CasesExhausted exceptions.
+        """
+        if on_failure not in ('skip', 'yield', 'raise'):
+            raise ValueError("on_failure must be 'skip', 'yield' or 'raise'")
+        return map_results(partial(cls.__new__, cls), values,
+                           on_failure, CasesExhausted)
+
+    @classmethod
+    def parallel_map(cls, values, workers=None, chunksize=256):
+        """Return a list of the results of matching each of 'values'
+        against the cases, spread over a pool of 'workers' processes
+        (by default, one per CPU) in chunks of 'chunksize'.
+
+        The class is sent to the workers by reference, so each of
+        them rebuilds the cases by importing the module the class is
+        defined in; it must be defined at the top level of a module.
+        The values and results must be picklable.
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(partial(apply_cases, cls), values,
+                                     chunksize=chunksize))
+
+def apply_cases(cls, value):
+    """Match 'value' against the cases of 'cls' (in a worker process)."""
+    return cls(value)
+
+MemoInfo = namedtuple('MemoInfo', 'hits misses unhashable maxsize '
+                      'currsize hit_ratio')
+
+class CaseMemo:
+    """The results remembered by a MatchCases class defined with
+    memoize=True, least recently used first.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = self.misses = self.unhashable = 0
+
+def memoized_cases(cls, value):
+    """MatchCases.__new__ for classes defined with memoize=True.
+    Values that are equal and hold values of the same types are
+    taken to give the same result, so the cases should be pure
+    functions of the values and their results should not be changed
+    by the callers.
+    """
+    memo = cls.__dict__.get('_memo')
+    if memo is None:
+        # A subclass that isn't memoized itself.
+        return MatchCases.__new__(cls, value)
+    key = memo_key(value)
+    results = memo.results
+    try:
+        result = results[key]
+    except KeyError:
+        pass
+    except TypeError:
+        memo.unhashable += 1
+        return MatchCases.__new__(cls, value)
+    else:
+        memo.hits += 1
+        results.move_to_end(key)
+        return result
+    memo.misses += 1
+    result = results[key] = MatchCases.__new__(cls, value)
+    if len(results) > memo.maxsize:
+        results.popitem(last=False)
+    return result
+
+def memo_key(value):
+    """Return the key the result for 'value' is remembered by: the
+    value with the types of the values in it, so that e.g. 1, 1.0
+    and True, or Ty(Lit(1)) and Ty(Lit(1.0)), stay apart.
+    """
+    if not isinstance(value, (tuple, frozenset)):
+        return (value, type(value))
+    return (value, value_types((value,)))
+
+def learning_cases(cls, value):
+    """MatchCases.__new__ for a class that is learning the order
+    of its cases, counting the matches of each case.
+    """
+    try:
+        cases = cls._case_table[type(value)]
+    except KeyError:
+        cases = cls.cases_for_type(type(value))
+    for name, action, pattern, matcher in separate_regex_cases(cases):
+        try:
+            bindings = matcher.match_unguarded(value)
+            break
+        except MatchFailed:
+            pass
+    else:
+        raise CasesExhausted('no case for %r in %r', value, cls)
+
+    learning = cls.__dict__.get('_learning')
+    if learning is not None:
+        learning[1][name] += 1
+        learning[0] -= 1
+        if learning[0] <= 0:
+            # Done: go back to the usual __new__.
+            if learning[2] is None:
+                del cls.__new__
+            else:
+                cls.__new__ = learning[2]
+            del cls._learning
+            cls.reorder(learning[1])
+
+    if action.patch_in_args:
+        return action(value, *bindings)
+    else:
+        return action(value, bindings)
+
+def combine_regex_cases(cases):
+    """Return 'cases' with each run of cases whose patterns are all
+    regular expressions replaced by a single case that tries them
+    with one scan of the value, where that can be done.
+    """
+    result = []
+    run = []
+    for case in chain(cases, [None]):
+        if case is not None and type(case.pattern) is regex_type:
+            run.append(case)
+            continue
+        combined = combined_regexps(tuple(run)) if len(run) > 1 else None
+        if combined is not None:
+            result.append(Case(combined.name, run_combined_case,
+                               combined.regex, combined))
+        else:
+            result.extend(run)
+        run = []
+        if case is not None:
+            result.append(case)
+    return result
+
+# Matches the parts of regular expressions that stop them from being
+# combined: backreferences, conditionals and global inline flags.
+uncombinable_re = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+class CombinedRegexps:
+    """Matcher for the regular expressions of a run of cases,
+    joined into one alternation. Python tries the alternatives in
+    order, so the first case whose expression matches is found, as
+    if the expressions had been tried one by one.
+    """
+    def __init__(self, regex, cases, starts):
+        self.regex = regex
+        self.name = '|'.join(case.name for case in cases)
+        self.run = cases
+        # Maps the number of the group around each case's
+        # expression to the case and the names of its groups.
+        self.cases = {start: (case, regex_groups(case.pattern))
+                      for start, case in zip(starts, cases)}
+        self.guard = None
+
+    def match_unguarded(self, value):
+        """Return the case that matches 'value' and its bindings."""
+        match = match_regex(self.regex, value)
+        case, groups = self.cases[match.lastindex]
+        return case, case.matcher._captured._make(group_values(match,
+                                                               groups))
+
+@lru_cache(maxsize=256)
+def combined_regexps(cases):
+    """Return a CombinedRegexps for the tuple 'cases', or None if
+    their expressions can't be combined without changing them.
+    """
+    patterns = [case.pattern for case in cases]
+    first = patterns[0]
+    source_type = type(first.pattern)
+    names = [name for pattern in patterns for name in pattern.groupindex]
+    if len(set(names)) != len(names):
+        return None
+    for pattern in patterns:
+        if (type(pattern.pattern) is not source_type
+            or pattern.flags != first.flags):
+            return None
+        source = pattern.pattern
+        if source_type is bytes:
+            source = source.decode('latin-1')
+        if uncombinable_re.search(source):
+            return None
+    if source_type is bytes:
+        source = b'|'.join(b'(' + pattern.pattern + b')'
+                           for pattern in patterns)
+    else:
+        source = '|'.join('(' + pattern.pattern + ')' for pattern in patterns)
+    try:
+        regex = re.compile(source, first.flags)
+    except re.error:
+        return None
+    starts = []
+    start = 1
+    for pattern in patterns:
+        starts.append(start)
+        start += pattern.groups + 1
+    return CombinedRegexps(regex, cases, starts)
+
+def separate_regex_cases(cases):
+    """Yield 'cases' with the cases made by combine_regex_cases
+    replaced by the cases they were made from, for profiling and
+    learning, which count the attempts and matches of each case.
+    """
+    for case in cases:
+        if type(case.matcher) is CombinedRegexps:
+            yield from case.matcher.run
+        else:
+            yield case
 
+def run_combined_case(value, case, bindings):
+    """Action for a case made by combine_regex_cases, which runs
+    the action of the case that matched.
+    """
+    if case.action.patch_in_args:
+        return case.action(value, *bindings)
+    return case.action(value, bindings)
+run_combined_case.patch_in_args = True
+
+def reorder_cases(cases, hits, valuetype):
+    """Return 'cases', the cases for values of type 'valuetype',
+    with the cases that have the most hits as early as they can be
+    without passing an earlier case that could match the same
+    values.
+    """
+    if not any(hits.get(case.name) for case in cases):
+        return cases
+    # The earlier cases each case has to stay after.
+    after = [{earlier for earlier in range(index)
+              if not cases_disjoint(cases[earlier], case, valuetype)}
+             for index, case in enumerate(cases)]
+    placed = set()
+    order = []
+    while len(order) < len(cases):
+        ready = [index for index in range(len(cases))
+                 if index not in placed and after[index] <= placed]
+        best = max(ready, key=lambda index: (hits.get(cases[index].name, 0),
+                                             -index))
+        placed.add(best)
+        order.append(cases[best])
+    return order
+
+def cases_disjoint(case, other, valuetype):
+    """Return whether no value of type 'valuetype' can match the
+    patterns of both cases.
+    """
+    return (not could_match_type(case.pattern, valuetype)
+            or not could_match_type(other.pattern, valuetype)
+            or disjoint(case.pattern, other.pattern))
+
+class PatternKinds(Singleton):
+    """A handler for dispatch that returns the kind of a pattern."""
+    def __getattr__(self, kind):
+        return lambda pattern: kind
+
+def pattern_kind(pattern):
+    """Return the name of the method that dispatch would call for
+    'pattern', e.g. 'binding' or 'adt_instance'.
+    """
+    try:
+        kind = _pattern_kinds[type(pattern)]
+        if kind is None:
+            kind = _class_pattern_kinds[pattern]
+        return kind
+    except KeyError:
+        return dispatch(pattern, PatternKinds())
+
+class_kinds = {'adt_constructor', 'adt_instance',
+               'ast_constructor', 'ast_instance'}
+
+# Literals of these types are equal only to values that are also
+# equal to each other, so unequal literals can't match one value.
+simple_literal_types = (int, float, complex, str, bytes, bool,
+                        type(None), type)
+
+def pattern_class(pattern, kind):
+    """Return the class whose instances a constructor or instance
+    pattern can match, or None if that isn't known.
+    """
+    cls = pattern if kind.endswith('constructor') else type(pattern)
+    if type(cls).__instancecheck__ is type.__instancecheck__:
+        return cls
+    if isinstance(cls, getattr(ast, '_ABC', ())):
+        # The deprecated AST classes like ast.Str match constants.
+        return ast.Constant
+    return None
+
+def could_match_type(pattern, valuetype):
+    """Return False if no value of type 'valuetype' can match
+    'pattern', because it requires a class that the type isn't a
+    subclass of.
+    """
+    kind = pattern_kind(pattern)
+    if kind not in class_kinds:
+        return True
+    cls = pattern_class(pattern, kind)
+    return cls is None or issubclass(valuetype, cls)
+
+def fixed_items(pattern):
+    """Return the items of a sequence pattern before its first
+    BindingRest, and whether it has one.
+    """
+    fixed = []
+    for item in pattern:
+        if isinstance(item, BindingRest):
+            return fixed, True
+        fixed.append(item)
+    return fixed, False
+
+def disjoint(pattern, other):
+    """Return whether no value can match both patterns, as far as
+    can be told from the patterns alone; False means that they may
+    overlap. ADT variants and AST classes are taken not to be
+    combined by multiple inheritance.
+    """
+    kind, other_kind = pattern_kind(pattern), pattern_kind(other)
+    if kind == 'binding' or other_kind == 'binding':
+        return False
+    if other_kind in class_kinds and kind not in class_kinds:
+        pattern, other = other, pattern
+        kind, other_kind = other_kind, kind
+    if kind in class_kinds:
+        cls = pattern_class(pattern, kind)
+        if cls is None:
+            return False
+        if other_kind in class_kinds:
+            other_cls = pattern_class(other, other_kind)
+            if other_cls is None:
+                return False
+            if not (issubclass(cls, other_cls) or issubclass(other_cls, cls)):
+                return True
+            if kind == other_kind and type(pattern) is type(other):
+                if kind == 'adt_instance':
+                    return any(map(disjoint, pattern, other))
+                if kind == 'ast_instance':
+                    return any(disjoint(getattr(pattern, field, None),
+                                        getattr(other, field, None))
+                               for field in pattern._fields)
+            return False
+        if other_kind == 'literal' and type(other) in simple_literal_types:
+            return not isinstance(other, cls)
+        if other_kind == 'regexp':
+            return not issubclass(cls, (str, bytes))
+        return False
+    if kind == other_kind == 'literal':
+        return (type(pattern) in simple_literal_types
+                and type(other) in simple_literal_types
+                and pattern != other)
+    if kind == other_kind == 'mapping':
+        # A mapping with exactly the keys of one pattern lacks any
+        # other key the other pattern requires.
+        if isinstance(pattern, ExactKeys) and not set(other) <= set(pattern):
+            return True
+        if isinstance(other, ExactKeys) and not set(pattern) <= set(other):
+            return True
+        return any(disjoint(pattern[key], other[key])
+                   for key in pattern.keys() if key in other)
+    if kind == other_kind == 'sequence':
+        # The matchers stop at the first BindingRest, wherever it is.
+        fixed, rest = fixed_items(pattern)
+        other_fixed, other_rest = fixed_items(other)
+        if ((not rest and len(fixed) < len(other_fixed))
+            or (not other_rest and len(other_fixed) < len(fixed))
+            or (not rest and not other_rest and len(fixed) != len(other_fixed))):
+            return True
+        return any(map(disjoint, fixed, other_fixed))
+    return False
+
+class CaseStats:
+    """What a profile found out about one case of a MatchCases
+    class. Times are in seconds, and the time spent in actions
+    includes the time spent in any matching they do.
+    """
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        # Failed attempts of earlier cases before this one matched.
+        self.failed_before = 0
+        self.match_time = 0.0
+        self.action_time = 0.0
+
+class PatternStats:
+    """What a profile found out about one pattern used with match()."""
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.attempts = 0
+        self.successes = 0
+        self.time = 0.0
+
+class MatchStats:
+    """The statistics gathered by 'profile()'. 'cases' maps each
+    MatchCases class to an OrderedDict of the CaseStats of each of
+    its cases that was tried, 'depths' maps each class to a Counter
+    of the number of cases tried per call, and 'exhausted' counts
+    the calls for which none matched. 'patterns' holds PatternStats
+    for the patterns used with match().
+    """
+    def __init__(self):
+        self.cases = OrderedDict()
+        self.depths = {}
+        self.exhausted = Counter()
+        self.patterns = OrderedDict()
+
+    def case(self, cls, name):
+        try:
+            return self.cases[cls][name]
+        except KeyError:
+            cases = self.cases.setdefault(cls, OrderedDict(
+                (case.name, CaseStats()) for case in cls._cases))
+            return cases[name]
+
+    def record_attempt(self, cls, name, matched, elapsed, tried):
+        stats = self.case(cls, name)
+        stats.attempts += 1
+        stats.match_time += elapsed
+        if matched:
+            stats.successes += 1
+            stats.failed_before += tried
+        else:
+            stats.failures += 1
+
+    def record_call(self, cls, name, tried, elapsed):
+        """Record a call that tried 'tried' cases, ending with a
+        match of case 'name' whose action took 'elapsed' seconds, or
+        with no match if 'name' is None.
+        """
+        self.depths.setdefault(cls, Counter())[tried] += 1
+        if name is None:
+            self.exhausted[cls] += 1
+        else:
+            self.case(cls, name).action_time += elapsed
+
+    def record_pattern(self, compiled, matched, elapsed):
+        try:
+            stats = self.patterns[compiled]
+        except KeyError:
+            stats = self.patterns[compiled] = PatternStats(compiled.pattern)
+        stats.attempts += 1
+        stats.successes += matched
+        stats.time += elapsed
+
+    def report(self, limit=10):
+        """Return a table of the statistics for each class and its
+        cases, followed by the cases whose matches cost the most
+        failed attempts of the cases before them, which are the ones
+        to consider moving up.
+        """
+        lines = []
+        for cls, cases in self.cases.items():
+            depths = self.depths.get(cls, Counter())
+            calls = sum(depths.values())
+            tried = sum(depth * count for depth, count in depths.items())
+            lines.append('%s.%s: %d calls, %d exhausted, %.2f cases '
+                         'tried per call' % (
+                             cls.__module__, cls.__qualname__, calls,
+                             self.exhausted[cls], tried / (calls or 1)))
+            lines.append('  %-20s %9s %9s %9s %9s %11s %11s' % (
+                'case', 'attempts', 'matched', 'failed', 'failed',
+                'match time', 'action time'))
+            lines.append('  %-20s %9s %9s %9s %9s' % (
+                '', '', '', '', 'before'))
+            for name, stats in cases.items():
+                lines.append('  %-20s %9d %9d %9d %9d %11.6f %11.6f' % (
+                    name, stats.attempts, stats.successes, stats.failures,
+                    stats.failed_before, stats.match_time,
+                    stats.action_time))
+        costly = sorted(((stats.failed_before, cls, name, stats)
+                         for cls, cases in self.cases.items()
+                         for name, stats in cases.items()
+                         if stats.failed_before),
+                        key=lambda item: -item[0])[:limit]
+        if costly:
+            lines.append('Cases to consider moving up:')
+            for failed, cls, name, stats in costly:
+                lines.append('  %s.%s: %d failed attempts before %d '
+                             'matches' % (cls.__qualname__, name,
+                                          failed, stats.successes))
+        if self.patterns:
+            lines.append('Patterns used with match():')
+            lines.append('  %9s %9s %11s  %s' % ('attempts', 'matched',
+                                                'time', 'pattern'))
+            for stats in self.patterns.values():
+                lines.append('  %9d %9d %11.6f  %.60r' % (
+                    stats.attempts, stats.successes, stats.time,
+                    stats.pattern))
+        return '\n'.join(lines)
+
+# The MatchStats of the profiles in progress.
+_profiles = []
+
+@contextmanager
+def profile():
+    """Context manager that gathers statistics about the cases of
+    every MatchCases class and the patterns used with match() while
+    it is active, and yields the MatchStats they go in. Nothing is
+    gathered, and nothing is slowed down, outside of a profile. This
+    affects all threads. Runs of regular expression cases, which
+    are otherwise tried with one scan, are tried one by one so that
+    each case is counted.
+    """
+    stats = MatchStats()
+    if not _profiles:
+        MatchCases.__new__ = staticmethod(profiled_cases)
+        CompiledPattern.match = profiled_match
+    _profiles.append(stats)
+    try:
+        yield stats
+    finally:
+        _profiles.remove(stats)
+        if not _profiles:
+            MatchCases.__new__ = unprofiled_cases
+            CompiledPattern.match = unprofiled_match
+
+unprofiled_cases = MatchCases.__dict__['__new__']
+unprofiled_match = CompiledPattern.match
+
+def profiled_cases(cls, value):
+    """MatchCases.__new__, timing each case and counting the cases
+    tried for each value.
+    """
+    try:
+        cases = cls._case_table[type(value)]
+    except KeyError:
+        cases = cls.cases_for_type(type(value))
+    tried = 0
+    for name, action, pattern, matcher in separate_regex_cases(cases):
+        start = perf_counter()
+        try:
+            bindings = matcher.match_unguarded(value)
+        except MatchFailed:
+            elapsed = perf_counter() - start
+            for stats in _profiles:
+                stats.record_attempt(cls, name, False, elapsed, tried)
+            tried += 1
+            continue
+        elapsed = perf_counter() - start
+        for stats in _profiles:
+            stats.record_attempt(cls, name, True, elapsed, tried)
+        break
+    else:
+        for stats in _profiles:
+            stats.record_call(cls, None, tried, 0.0)
+        raise CasesExhausted('no case for %r in %r', value, cls)
+
+    start = perf_counter()
+    try:
         if action.patch_in_args:
-            return action(value, **bindings._asdict())
+            return action(value, *bindings)
         else:
             return action(value, bindings)
+    finally:
+        elapsed = perf_counter() - start
+        for stats in _profiles:
+            stats.record_call(cls, name, tried + 1, elapsed)
+
+def profiled_match(self, value):
+    """CompiledPattern.match, timing each match."""
+    start = perf_counter()
+    try:
+        result = unprofiled_match(self, value)
+    except MatchFailed:
+        elapsed = perf_counter() - start
+        for stats in _profiles:
+            stats.record_pattern(self, False, elapsed)
+        raise
+    elapsed = perf_counter() - start
+    for stats in _profiles:
+        stats.record_pattern(self, True, elapsed)
+    return result
 
 def ast_kwargs(Ctr, **kwargs):
     return Ctr(*[kwargs.get(field, Binding(field))
@@ -0,0 +1,569 @@
+# Copyright 2013 Ben Anhalt
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A compact binary encoding for values of algebraic data types.
+
+The encoding is driven by a Schema built from the generic types
+involved. Each variant is written as a small integer tag followed by
+its fields, and fields declared as Require(int), Require(float) or
+Require(str) are written without any type information:
+
+    int      zigzag varint
+    float    8 bytes, little endian
+    str      varint length, UTF-8
+    ADT      tag, fields (Require of an ADT type)
+    other    a marker byte and the value (see encode_any)
+
+Subclasses of int in int fields, such as bool and IntEnum, are
+written as plain ints and decoded as such.
+
+Values that are none of None, bool, int, float, str, bytes or an ADT
+in the schema can only be written with pickle, which a schema only
+does when built with allow_pickle=True. Decoding such data runs
+pickle.loads, which can run arbitrary code, so data from untrusted
+sources must only be decoded by schemas without allow_pickle.
+
+Neither encoding nor decoding recurses, so trees of any depth can
+be handled.
+
+A schema built with sized=True also writes the length of every node
+that is followed by other fields, so that a View of the encoded data,
+such as a memory mapped file, can find any field of a node without
+decoding the ones before it.
+"""
+
+from struct import Struct, error as struct_error
+import pickle
+import mmap
+
+from adt import ADT, AlgebraicMeta, Require, Interned, Singleton
+
+# Field kinds. The SIZED kinds are nodes, or values that may be
+# nodes, which are written after their length in a sized schema.
+INT, FLOAT, STR, NODE, ANY, SIZED_NODE, SIZED_ANY = range(7)
+
+# Markers for values in fields of kind ANY.
+(ANY_NONE, ANY_FALSE, ANY_TRUE, ANY_INT, ANY_FLOAT, ANY_STR, ANY_BYTES,
+ ANY_NODE, ANY_PICKLE) = range(9)
+
+double = Struct('<d')
+size = Struct('<Q')
+
+class DecodeError(ValueError):
+    pass
+
+def field_kind(constraint):
+    """Return how a field with the given constraint is encoded."""
+    if type(constraint) is Require:
+        if constraint.dtype is int:
+            return INT
+        if constraint.dtype is float:
+            return FLOAT
+        if constraint.dtype is str:
+            return STR
+        if isinstance(constraint.dtype, type) and issubclass(
+                constraint.dtype, ADT):
+            return NODE
+    return ANY
+
+def generic_type(cls):
+    """Return the generic type that the ADT class 'cls' belongs to."""
+    for base in cls.__mro__:
+        if ADT in base.__bases__:
+            return base
+    raise TypeError("%r is not an algebraic data type" % cls)
+
+class Schema:
+    """The encoding of the variants of the given generic types and
+    of any others that their fields require. Encoded data can only
+    be decoded by a schema built from the same definitions.
+    """
+    def __init__(self, *generics, sized=False, allow_pickle=False):
+        self.sized = sized
+        self.allow_pickle = allow_pickle
+        self.variants = []
+        self.tags = {}
+        self.kinds = []
+        self.view_types = {}
+        pending = [generic_type(generic) for generic in generics]
+        seen = set()
+        while pending:
+            generic = pending.pop(0)
+            if generic in seen:
+                continue
+            seen.add(generic)
+            for variant in generic._variants:
+                self.tags[variant] = len(self.variants)
+                self.variants.append(variant)
+                kinds = tuple(map(field_kind, variant._constraints))
+                pending.extend(generic_type(constraint.dtype)
+                               for constraint, kind in
+                               zip(variant._constraints, kinds)
+                               if kind is NODE)
+                if sized:
+                    # The last field never has to be skipped over.
+                    kinds = tuple(sized_kinds.get(kind, kind)
+                                  for kind in kinds[:-1]) + kinds[-1:]
+                self.kinds.append(kinds)
+
+    def dumps(self, value):
+        """Return the encoding of 'value', an instance of one of
+        the variants of the schema, as bytes.
+        """
+        out = bytearray()
+        self.encode(value, out)
+        return bytes(out)
+
+    def encode(self, value, out):
+        """Append the encoding of 'value' to the bytearray 'out'."""
+        tags = self.tags
+        kinds = self.kinds
+        # Each entry pairs the kinds of the fields of a node with the
+        # values of those fields that are still to be written. If the
+        # node's length has to be written before it, the position for
+        # it is on the 'sizes' stack.
+        stack = [iter(((NODE, value),))]
+        sizes = [None]
+        while stack:
+            for kind, value in stack[-1]:
+                if kind is INT:
+                    if not isinstance(value, int):
+                        raise TypeError("can't encode %r as an int" %
+                                        (value,))
+                    write_varint(zigzag(value), out)
+                    continue
+                elif kind is FLOAT:
+                    out += double.pack(value)
+                    continue
+                elif kind is STR:
+                    data = value.encode('utf-8')
+                    write_varint(len(data), out)
+                    out += data
+                    continue
+                elif ((kind is ANY or kind is SIZED_ANY)
+                      and not self.encode_any(value, out)):
+                    continue
+                tag = tags.get(type(value))
+                if tag is None:
+                    tag = self.tag_of(type(value))
+                if kind is SIZED_NODE or kind is SIZED_ANY:
+                    sizes.append(len(out))
+                    out += bytes(size.size)
+                else:
+                    sizes.append(None)
+                write_varint(tag, out)
+                # Write the fields of the node before those that follow.
+                stack.append(zip(kinds[tag], value))
+                break
+            else:
+                stack.pop()
+                start = sizes.pop()
+                if start is not None:
+                    size.pack_into(out, start, len(out) - start - size.size)
+
+    def encode_any(self, value, out):
+        """Append a marker for the type of 'value' and, unless it is
+        a node to be written next, its encoding. Returns whether it
+        is such a node.
+        """
+        valuetype = type(value)
+        if value is None:
+            out.append(ANY_NONE)
+        elif valuetype is bool:
+            out.append(ANY_TRUE if value else ANY_FALSE)
+        elif valuetype is int:
+            out.append(ANY_INT)
+            write_varint(zigzag(value), out)
+        elif valuetype is float:
+            out.append(ANY_FLOAT)
+            out += double.pack(value)
+        elif valuetype is str:
+            data = value.encode('utf-8')
+            out.append(ANY_STR)
+            write_varint(len(data), out)
+            out += data
+        elif valuetype is bytes:
+            out.append(ANY_BYTES)
+            write_varint(len(value), out)
+            out += value
+        elif valuetype in self.tags or (issubclass(valuetype, View) and
+                                        valuetype._variant in self.tags):
+            out.append(ANY_NODE)
+            return True
+        elif not self.allow_pickle:
+            raise TypeError("can't encode %r without allow_pickle=True" %
+                            (value,))
+        else:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            out.append(ANY_PICKLE)
+            write_varint(len(data), out)
+            out += data
+        return False
+
+    def tag_of(self, valuetype):
+        """Return the tag of 'valuetype', a variant of the schema or
+        a View of one, which is encoded like the variant itself.
+        """
+        try:
+            return self.tags[getattr(valuetype, '_variant', valuetype)]
+        except KeyError:
+            raise TypeError("%r is not in the schema" % valuetype) from None
+
+    def loads(self, data):
+        """Decode a value from 'data', a bytes-like object holding
+        exactly one encoded value.
+        """
+        try:
+            value, end = self.decode(memoryview(data), 0)
+        except (IndexError, struct_error):
+            raise DecodeError("truncated data") from None
+        if end != len(data):
+            raise DecodeError("%d bytes left over" % (len(data) - end))
+        return value
+
+    def decode(self, data, pos):
+        """Decode a value from the bytes-like object 'data' starting
+        at 'pos'. Returns the value and the position after it.
+        """
+        # Each frame is the variant being decoded, an iterator over
+        # the kinds of its remaining fields and the values decoded so
+        # far.
+        stack = []
+        tag, pos = read_varint(data, pos)
+        frame = self.start_frame(tag)
+        while True:
+            for kind in frame[1]:
+                if kind is INT:
+                    value, pos = read_varint(data, pos)
+                    frame[2].append(unzigzag(value))
+                    continue
+                elif kind is FLOAT:
+                    frame[2].append(double.unpack_from(data, pos)[0])
+                    pos += 8
+                    continue
+                elif kind is STR:
+                    length, pos = read_varint(data, pos)
+                    frame[2].append(str(data[pos:pos + length], 'utf-8'))
+                    pos += length
+                    continue
+                elif kind is ANY or kind is SIZED_ANY:
+                    marker = data[pos]
+                    pos += 1
+                    if marker != ANY_NODE:
+                        value, pos = decode_any(marker, data, pos,
+                                                self.allow_pickle)
+                        frame[2].append(value)
+                        continue
+                if kind is SIZED_NODE or kind is SIZED_ANY:
+                    pos += size.size
+                tag, pos = read_varint(data, pos)
+                stack.append(frame)
+                frame = self.start_frame(tag)
+                break
+            else:
+                # All of the fields are in.
+                value = self.build(frame[0], frame[2])
+                if not stack:
+                    return value, pos
+                frame = stack.pop()
+                frame[2].append(value)
+
+    def start_frame(self, tag):
+        try:
+            return (self.variants[tag], iter(self.kinds[tag]), [])
+        except IndexError:
+            raise DecodeError("unknown variant tag %d" % tag) from None
+
+    def build(self, variant, values):
+        """Make an instance of 'variant' from decoded values, which
+        were checked when they were encoded.
+        """
+        if issubclass(variant, (Interned, Singleton)):
+            return variant(*values)
+        return tuple.__new__(variant, values)
+
+    def skip(self, kind, data, pos):
+        """Return the position after a field of the given kind
+        starting at 'pos' in 'data', without decoding it.
+        """
+        if kind is INT:
+            return read_varint(data, pos)[1]
+        if kind is FLOAT:
+            return pos + 8
+        if kind is STR:
+            length, pos = read_varint(data, pos)
+            return pos + length
+        if kind is ANY or kind is SIZED_ANY:
+            marker = data[pos]
+            pos += 1
+            if marker != ANY_NODE:
+                return skip_any(marker, data, pos)
+        if kind is SIZED_NODE or kind is SIZED_ANY:
+            return pos + size.size + size.unpack_from(data, pos)[0]
+        # A node without its length has to be walked.
+        stack = []
+        while True:
+            tag, pos = read_varint(data, pos)
+            self.start_frame(tag)
+            stack.extend(reversed(self.kinds[tag]))
+            while True:
+                if not stack:
+                    return pos
+                kind = stack.pop()
+                if kind is NODE:
+                    break
+                if kind is ANY and data[pos] == ANY_NODE:
+                    pos += 1
+                    break
+                pos = self.skip(kind, data, pos)
+
+    def view(self, data, pos=0):
+        """Return a View of the value encoded at 'pos' in the
+        bytes-like object 'data', which is decoded only as its
+        fields are used. With a sized schema and a memory mapped
+        file, only the parts of the file that are used are read:
+
+            view = schema.view(mmap.mmap(file.fileno(), 0,
+                                         access=mmap.ACCESS_READ))
+        """
+        return self.view_node(memoryview(data), pos)
+
+    def view_file(self, path):
+        """Return a View of the value in the file at 'path', written
+        there by 'dumps', through a read only memory map.
+        """
+        with open(path, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.view(data)
+
+    def view_node(self, data, pos):
+        tag, fields = read_varint(data, pos)
+        try:
+            view_type = self.view_types[tag]
+        except KeyError:
+            variant = self.start_frame(tag)[0]
+            if not variant._fields:
+                # The instance is shared, so there is nothing to defer.
+                return variant()
+            view_type = self.view_types[tag] = make_view_type(
+                self, variant, self.kinds[tag])
+        view = tuple.__new__(view_type)
+        view._data = data
+        view._start = pos
+        view._offsets = [fields]
+        view._values = {}
+        return view
+
+    def decode_field(self, kind, data, pos):
+        """Decode a single field for a View. Nodes are returned as
+        Views in turn.
+        """
+        if kind is INT:
+            return unzigzag(read_varint(data, pos)[0])
+        if kind is FLOAT:
+            return double.unpack_from(data, pos)[0]
+        if kind is STR:
+            length, pos = read_varint(data, pos)
+            return str(data[pos:pos + length], 'utf-8')
+        if kind is ANY or kind is SIZED_ANY:
+            marker = data[pos]
+            pos += 1
+            if marker != ANY_NODE:
+                return decode_any(marker, data, pos, self.allow_pickle)[0]
+        if kind is SIZED_NODE or kind is SIZED_ANY:
+            pos += size.size
+        return self.view_node(data, pos)
+
+    def dump(self, value, file):
+        """Write 'value' to the binary file 'file' as a record that
+        'load_iter' can read back.
+        """
+        out = bytearray()
+        self.encode(value, out)
+        header = bytearray()
+        write_varint(len(out), header)
+        file.write(header + out)
+
+    def load_iter(self, file):
+        """Generate the values written to the binary file 'file' by
+        'dump', reading one record at a time.
+        """
+        while True:
+            length = read_varint_from(file)
+            if length is None:
+                return
+            data = file.read(length)
+            if len(data) != length:
+                raise DecodeError("truncated record")
+            yield self.loads(data)
+
+sized_kinds = {NODE: SIZED_NODE, ANY: SIZED_ANY}
+
+class View:
+    """Mixin for the types of the values returned by Schema.view.
+    A view of an encoded value is an instance of a subclass of the
+    value's variant, so it can be matched like the value itself,
+    but it only decodes a field when it is used.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self._kinds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if index < 0:
+            index += len(self._kinds)
+        try:
+            return self._values[index]
+        except KeyError:
+            pass
+        if not 0 <= index < len(self._kinds):
+            raise IndexError("tuple index out of range")
+        kinds = self._kinds
+        data = self._data
+        offsets = self._offsets
+        while len(offsets) <= index:
+            field = len(offsets) - 1
+            offsets.append(self._schema.skip(kinds[field], data,
+                                             offsets[field]))
+        value = self._values[index] = self._schema.decode_field(
+            kinds[index], data, offsets[index])
+        return value
+
+    def __iter__(self):
+        for index in range(len(self._kinds)):
+            yield self[index]
+
+    def __eq__(self, other):
+        if isinstance(other, View):
+            other = tuple(other)
+        return tuple(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return '%s(%s)' % (self._variant.__name__, ', '.join(
+            '%s=%r' % item for item in zip(self._fields, self)))
+
+    def __reduce_ex__(self, protocol):
+        return self.materialize().__reduce_ex__(protocol)
+
+    def _replace(self, **changes):
+        value = self._schema.build(self._variant, list(self))
+        return value._replace(**changes)
+
+    def materialize(self):
+        """Decode the whole value."""
+        return self._schema.decode(self._data, self._start)[0]
+
+def make_view_type(schema, variant, kinds):
+    """Make the View subclass of 'variant' for 'schema'."""
+    clsdict = {'_schema': schema, '_variant': variant, '_kinds': kinds,
+               '__module__': __name__}
+    for index, field in enumerate(variant._fields):
+        clsdict[field] = property(lambda self, index=index: self[index])
+    # Going around AlgebraicMeta keeps it out of the generic's variants.
+    return type.__new__(AlgebraicMeta, variant.__name__ + 'View',
+                        (View, variant), clsdict)
+
+def decode_any(marker, data, pos, allow_pickle=False):
+    """Decode a value other than a node written by encode_any.
+    Pickled values are only decoded if 'allow_pickle' is true.
+    """
+    if marker == ANY_NONE:
+        return None, pos
+    if marker == ANY_FALSE:
+        return False, pos
+    if marker == ANY_TRUE:
+        return True, pos
+    if marker == ANY_INT:
+        value, pos = read_varint(data, pos)
+        return unzigzag(value), pos
+    if marker == ANY_FLOAT:
+        return double.unpack_from(data, pos)[0], pos + 8
+    if marker in (ANY_STR, ANY_BYTES, ANY_PICKLE):
+        length, pos = read_varint(data, pos)
+        chunk = data[pos:pos + length]
+        pos += length
+        if marker == ANY_STR:
+            return str(chunk, 'utf-8'), pos
+        if marker == ANY_BYTES:
+            return bytes(chunk), pos
+        if not allow_pickle:
+            raise DecodeError("pickled value in data for a schema "
+                              "without allow_pickle=True")
+        return pickle.loads(chunk), pos
+    raise DecodeError("unknown value marker %d" % marker)
+
+def skip_any(marker, data, pos):
+    """Return the position after a value other than a node written
+    by encode_any, without decoding it.
+    """
+    if marker in (ANY_STR, ANY_BYTES, ANY_PICKLE):
+        length, pos = read_varint(data, pos)
+        return pos + length
+    return decode_any(marker, data, pos)[1]
+
+def zigzag(n):
+    """Map signed integers onto unsigned ones, small magnitudes first."""
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def unzigzag(n):
+    return n // 2 if not n & 1 else -(n + 1) // 2
+
+def write_varint(n, out):
+    """Append the unsigned integer 'n' to 'out', 7 bits per byte."""
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    """Return the unsigned integer at 'pos' in 'data' and the
+    position after it.
+    """
+    result = 0
+    shift = 0
+    try:
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result, pos
+            shift += 7
+    except IndexError:
+        raise DecodeError("truncated data") from None
+
+def read_varint_from(file):
+    """Read an unsigned varint from 'file', or return None at the end."""
+    result = 0
+    shift = 0
+    while True:
+        byte = file.read(1)
+        if not byte:
+            if shift:
+                raise DecodeError("truncated record header")
+            return None
+        result |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return result
+        shift += 7
@@ -1,10 +1,10 @@
 from adt import match, MatchCases, Binding as b, BindingRest as r, ast_kwargs as kw
 import ast
+import io
 
 class MatchMod(MatchCases):
     def module(match: ast.Module):
-        for stmt in body:
-            yield from MatchStmt(stmt)
+        yield from _unparser.lines(match)
 
 class MatchArg(MatchCases):
     def arg(match: kw(ast.arg, annotation=None)):
@@ -25,10 +25,13 @@ def make_call_args(call):
     arg_list = [MatchExpr(a) for a in call.args]
     arg_list.extend(MatchKeyword(kw)
                     for kw in call.keywords)
-    if call.starargs is not None:
-        arg_list.append('*(%s)' % MatchExpr(call.starargs))
-    if call.kwargs is not None:
-        arg_list.append('**(%s)' % MatchExpr(call.kwargs))
+    # Python 3.5 moved these into 'args' and 'keywords'.
+    starargs = getattr(call, 'starargs', None)
+    kwargs = getattr(call, 'kwargs', None)
+    if starargs is not None:
+        arg_list.append('*(%s)' % MatchExpr(starargs))
+    if kwargs is not None:
+        arg_list.append('**(%s)' % MatchExpr(kwargs))
     return '(%s)' % ', '.join(arg_list)
 
 class MatchKeyword(MatchCases):
@@ -145,12 +148,10 @@ class MatchAlias(MatchCases):
     def alias(match: ast.alias):
         return name + ' as ' + asname
 
-def make_body(body):
-    return ('    ' + line
-            for stmt in body
-            for line in MatchStmt(stmt))
-
 class MatchStmt(MatchCases):
+    # Each case yields the lines of the statement, with the list of
+    # statements in a nested block in place of its lines.
+
     def assertstmt(match: kw(ast.Assert, msg=None)):
         yield 'assert %s' % ( MatchExpr(test) )
 
@@ -169,7 +170,7 @@ class MatchStmt(MatchCases):
     def functiondef(match: ast.FunctionDef):
         arg_list = MatchArguments(args)
         yield 'def %s(%s):' % (name, arg_list)
-        yield from make_body(body)
+        yield body
 
     def passstmt(match: ast.Pass):
         yield 'pass'
@@ -188,22 +189,22 @@ class MatchStmt(MatchCases):
     def classdef(match: ast.ClassDef):
         bases_list = MatchClassBases(bases)
         yield 'class %s%s:' % (name, bases_list)
-        yield from make_body(body)
+        yield body
 
     def forstmt(match: ast.For):
         yield 'for %s in %s:' % (
             MatchExpr(target), MatchExpr(iter))
-        yield from make_body(body)
+        yield body
         if len(orelse) > 0:
             yield 'else:'
-            yield from make_body(orelse)
+            yield orelse
 
     def ifstmt(match: ast.If):
         yield 'if %s:' % MatchExpr(test)
-        yield from make_body(body)
+        yield body
         if len(orelse) > 0:
             yield 'else:'
-            yield from make_body(orelse)
+            yield orelse
 
     def returnstmt(match: ast.Return):
         yield 'return %s' % MatchExpr(value)
@@ -223,9 +224,154 @@ class MatchClassBases(MatchCases):
                               for base in bases)
         return '(%s)' % base_list
 
-st = ast.parse(open(__file__).read())
-
-for line in MatchMod(st):
-    print(line)
+class Unparser:
+    """Renders Python ASTs as source code, remembering the lines of
+    each statement so that rendering a tree again only renders the
+    statements that are new or have been changed. A statement is
+    taken to be unchanged if its fields, and those of the expressions
+    and lists in it, still hold the same nodes and equal values; the
+    statements in its nested blocks are checked in turn. Only the
+    statements used by the last tree rendered are remembered.
+    """
+    indent = '    '
+
+    def __init__(self):
+        # Maps the ids of statements to the statements, the state
+        # they were rendered in and their parts.
+        self.cache = {}
+
+    def parts(self, stmt, used):
+        """Return the lines of 'stmt' and the lists of statements
+        in its nested blocks, in order, and add its entry in the
+        cache to 'used'.
+        """
+        try:
+            entry = self.cache[id(stmt)]
+            if entry[0] is stmt and same_state(entry[1]):
+                used[id(stmt)] = entry
+                return entry[2]
+        except KeyError:
+            pass
+        entry = used[id(stmt)] = (stmt, statement_state(stmt),
+                                  list(MatchStmt(stmt)))
+        return entry[2]
+
+    def invalidate(self, stmt):
+        """Forget the rendering of 'stmt'."""
+        self.cache.pop(id(stmt), None)
+
+    def clear(self):
+        self.cache.clear()
+
+    def lines(self, node):
+        """Generate the lines of source for a module, a statement or
+        an expression.
+        """
+        if isinstance(node, ast.expr):
+            yield MatchExpr(node)
+            return
+        statements = node.body if isinstance(node, ast.Module) else [node]
+        used = {}
+        # Each entry is an iterator over statements, lines and nested
+        # blocks, and the indentation for its lines.
+        stack = [(iter(statements), '')]
+        while stack:
+            items, indent = stack[-1]
+            for item in items:
+                if type(item) is str:
+                    yield indent + item
+                elif type(item) is list:
+                    stack.append((iter(item), indent + self.indent))
+                    break
+                else:
+                    stack.append((iter(self.parts(item, used)), indent))
+                    break
+            else:
+                stack.pop()
+        # Forget the statements that weren't used, such as those that
+        # have been replaced.
+        self.cache = used
+
+    def write(self, node, out):
+        """Write the source for 'node' to the text file 'out'."""
+        write = out.write
+        for line in self.lines(node):
+            write(line)
+            write('\n')
+
+    def unparse(self, node):
+        """Return the source for 'node'."""
+        out = io.StringIO()
+        self.write(node, out)
+        return out.getvalue()
+
+def statement_state(stmt):
+    """Return the attribute dicts of the nodes that the lines of
+    'stmt' are rendered from and the lists in them, down to the
+    statements in its nested blocks, with copies of each, and the
+    types of the values of its numbers, for same_state.
+    """
+    dicts = []
+    lists = []
+    numbers = []
+    stack = [stmt]
+    pop, push = stack.pop, stack.append
+    while stack:
+        node = pop()
+        if type(node) is list:
+            lists.append(node)
+            values = node
+        else:
+            attributes = node.__dict__
+            dicts.append(attributes)
+            values = map(attributes.get, node._fields)
+            if type(node) in number_fields:
+                numbers.append((attributes, number_fields[type(node)]))
+        for value in values:
+            if type(value) is list or (isinstance(value, ast.AST) and
+                                       not isinstance(value, unchecked_nodes)):
+                push(value)
+    return (dicts, list(map(dict.copy, dicts)), lists, list(map(list, lists)),
+            numbers, number_types(numbers))
+
+# Statements are checked in turn, and contexts have no fields.
+unchecked_nodes = (ast.stmt, ast.expr_context)
+
+# The fields of the nodes for numbers, which can hold values that are
+# equal but written differently, like 1, 1.0 and True.
+number_fields = {getattr(ast, name): field
+                 for name, field in [('Num', 'n'), ('Constant', 'value')]
+                 if hasattr(ast, name)}
+
+def number_types(numbers):
+    return [type(attributes.get(field)) for attributes, field in numbers]
+
+def same_state(state):
+    """Return whether the nodes and lists in 'state', as returned by
+    statement_state, still hold the same values. The nodes in them
+    are compared by identity, and the numbers by type as well.
+    """
+    dicts, dict_copies, lists, list_copies, numbers, types = state
+    return (dicts == dict_copies and lists == list_copies
+            and number_types(numbers) == types)
+
+# The Unparser used by unparse() and MatchMod.
+_unparser = Unparser()
+
+def unparse(node, out=None):
+    """Return the source for 'node', or write it to the text file
+    'out' if one is given. The statements of the last tree rendered
+    are remembered, so rendering a tree again after editing it only
+    renders the statements that were changed, as for Unparser.
+    """
+    if out is None:
+        return _unparser.unparse(node)
+    _unparser.write(node, out)
+
+if __name__ == '__main__':
+    st = ast.parse(open(__file__).read())
+
+    for line in MatchMod(st):
+        print(line)
 
 
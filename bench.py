@@ -0,0 +1,556 @@
+# Copyright 2013 Ben Anhalt
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for constructing and pattern matching ADTs.
+
+Run all the benchmarks, or those whose names contain one of the
+given strings, and optionally save the results as JSON:
+
+    python bench.py [-b match -b cases] [-o results.json]
+
+Compare two saved runs, exiting with status 1 if any benchmark got
+slower by more than the threshold:
+
+    python bench.py --compare old.json new.json [--threshold 0.1]
+
+Run the benchmarks once under adt.profile() and print its report of
+which cases are tried and matched:
+
+    python bench.py --profile [-b ast2py]
+
+Time MatchCases.parallel_map with from 1 to N worker processes:
+
+    python bench.py --scaling N
+
+Each benchmark is calibrated to run for at least --min-time seconds
+per sample, and the mean and standard deviation of the samples are
+reported. The workloads are fixed, so runs are comparable.
+"""
+
+from collections import OrderedDict
+from time import perf_counter
+import tracemalloc
+import argparse
+import platform
+import statistics
+import pickle
+import json
+import ast
+import sys
+import re
+
+from adt import (ADT, Anything, Require, Binding as b, BindingRest,
+                 ast_kwargs as kw, dispatch, MatchVisitor, MatchCases,
+                 MatchCasesMeta, MatchFailed, unzip, match, match_iter,
+                 extract_bindings, unchecked, digest, edit, fold,
+                 profile)
+from adtcodec import Schema
+import ast2py
+
+class List(ADT):
+    pass
+
+class Nil(List):
+    pass
+
+class Cons(List):
+    car = Anything()
+    cdr = Require(List)
+
+class DictCons(List, slots=False):
+    car = Anything()
+    cdr = Require(List)
+
+def interpret(pattern, value):
+    """Match the way match() did before patterns were compiled."""
+    return unzip(dispatch(pattern, MatchVisitor(value)))
+
+def make_list(length, variant=Cons):
+    lst = Nil()
+    for i in range(length):
+        lst = variant(i, lst)
+    return lst
+
+# Each benchmark is a function taking no arguments and returning
+# the function to be timed.
+benchmarks = OrderedDict()
+
+def benchmark(name):
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+@benchmark('construct/cons_list_1000')
+def construct_cons_list():
+    return lambda: make_list(1000)
+
+@benchmark('construct/cons_list_1000_unchecked')
+def construct_cons_list_unchecked():
+    def run():
+        with unchecked():
+            make_list(1000)
+    return run
+
+@benchmark('construct/from_columns_1000')
+def construct_from_columns():
+    cars = list(range(1000))
+    cdrs = [Nil()] * 1000
+    return lambda: Cons.from_columns(cars, cdrs)
+
+tele_re = re.compile(r"(?P<area_code>\d{3})-"
+                     r"(?P<exchange>\d{3})-"
+                     r"(?P<subscriber>\d{4})")
+
+lst = make_list(3)
+
+match_workloads = [
+    ('adt', Cons(b('a'), Cons(b('b'), Cons(0, b('rest')))), lst),
+    ('adt_constructor', Cons, lst),
+    ('ast', kw(ast.BinOp, op=ast.Add(), left=kw(ast.Name, ctx=b(''))),
+     ast.parse('x + 1', mode='eval').body),
+    ('regex', Cons(tele_re, b('tail')), Cons('555-867-5309', Nil())),
+    ('mapping', {'a': 1, 'list': Cons, 'foo': b('foo')},
+     {'a': 1, 'list': lst, 'foo': 'bar', 'b': 2}),
+    ('sequence', [0, b('second'), 2, BindingRest('rest')], range(10)),
+]
+
+def match_benchmark(pattern, value):
+    return lambda: lambda: match(pattern, value)
+
+def visitor_benchmark(pattern, value):
+    return lambda: lambda: interpret(pattern, value)
+
+for name, pattern, value in match_workloads:
+    benchmark('match/' + name)(match_benchmark(pattern, value))
+    benchmark('match_visitor/' + name)(visitor_benchmark(pattern, value))
+
+json_pattern = {'key%d' % i: b('value%d' % i) if i % 5 == 0 else i
+                for i in range(50)}
+json_value = dict({'key%d' % i: i for i in range(50)}, extra=True)
+
+@benchmark('match/mapping_50_keys')
+def match_mapping_large():
+    return lambda: match(json_pattern, json_value)
+
+@benchmark('match/mapping_50_keys_missing')
+def match_mapping_missing():
+    # The last key is missing, which is found before any values match.
+    value = dict(json_value)
+    del value['key49']
+    def run():
+        try:
+            match(json_pattern, value)
+        except MatchFailed:
+            pass
+    return run
+
+@benchmark('match/failure_deep_value')
+def match_failure():
+    pattern = Cons('x', b('rest'))
+    value = make_list(1000)
+    def run():
+        try:
+            match(pattern, value)
+        except Exception:
+            pass
+    return run
+
+stream = [Cons(i, Nil()) if i % 3 else Nil() for i in range(1000)]
+
+@benchmark('stream/match_loop_1000')
+def match_loop():
+    pattern = Cons(b('x'), Nil())
+    def run():
+        for value in stream:
+            try:
+                match(pattern, value)
+            except MatchFailed:
+                pass
+    return run
+
+@benchmark('stream/match_iter_1000')
+def stream_match_iter():
+    pattern = Cons(b('x'), Nil())
+    return lambda: list(match_iter(pattern, stream))
+
+@benchmark('match/deep_pattern_10000')
+def match_deep():
+    pattern = make_list(10000)
+    value = make_list(10000)
+    return lambda: match(pattern, value)
+
+class Shape(ADT):
+    pass
+
+# Enough variants for the largest MatchCases benchmark.
+shape_variants = [type(Shape)('Shape%d' % i, (Shape,),
+                              OrderedDict(size=Require(int)))
+                  for i in range(200)]
+
+def make_cases(patterns, **options):
+    """Build a MatchCases class with a case for each pattern."""
+    clsdict = OrderedDict()
+    for i, pattern in enumerate(patterns):
+        def case(match, bindings, i=i):
+            return i
+        case.__annotations__ = {'match': pattern}
+        clsdict['case%d' % i] = case
+    return MatchCasesMeta('Cases%d' % len(patterns), (MatchCases,),
+                          clsdict, **options)
+
+def cases_benchmark(patterns, values):
+    def setup():
+        cases = make_cases(patterns)
+        def run():
+            for value in values:
+                cases(value)
+        return run
+    return setup
+
+for count in (5, 50, 200):
+    # Values spread evenly over the cases.
+    step = max(count // 5, 1)
+    benchmark('cases/variants_%d' % count)(cases_benchmark(
+        [variant(b('size')) for variant in shape_variants[:count]],
+        [shape_variants[i](i) for i in range(0, count, step)]))
+    benchmark('cases/literals_%d' % count)(cases_benchmark(
+        list(range(count)), list(range(0, count, step))))
+
+@benchmark('cases/literals_200_reordered')
+def cases_reordered():
+    # Most values match the last case, which is moved to the front.
+    cases = make_cases(list(range(200)))
+    values = [199] * 9 + [0]
+    cases.reorder({'case199': 9, 'case0': 1})
+    def run():
+        for value in values:
+            cases(value)
+    return run
+
+@benchmark('cases/literals_200_memoized')
+def cases_memoized():
+    cases = make_cases(list(range(200)), memoize=True)
+    values = list(range(0, 200, 40))
+    def run():
+        for value in values:
+            cases(value)
+    return run
+
+log_levels = ['DEBUG', 'INFO', 'NOTICE', 'WARNING', 'ERROR', 'CRITICAL',
+              'ALERT', 'EMERGENCY']
+log_lines = ['%s 2013-06-01 12:00:%02d message %d' % (level, i, i)
+             for i, level in enumerate(log_levels * 25)]
+
+@benchmark('cases/regex_8_levels')
+def cases_regex():
+    # The expressions are tried with a single scan of each line.
+    cases = make_cases([re.compile('%s (?P<time_%s>\\S+ \\S+) (?P<text_%s>.*)'
+                                   % (level, level, level))
+                        for level in log_levels])
+    def run():
+        for line in log_lines:
+            cases(line)
+    return run
+
+class Pair(List, slots=False):
+    first = Anything()
+    rest = Require(List)
+
+@benchmark('digest/cons_list_1000')
+def digest_list():
+    lst = make_list(1000)
+    return lambda: digest(lst)
+
+@benchmark('digest/replace_head_1000')
+def digest_replace():
+    # The digests of the rest of the list are remembered.
+    lst = make_list(1000, Pair)
+    digest(lst)
+    return lambda: digest(lst._replace(first=-1))
+
+@benchmark('update/edit_10_in_1000')
+def update_edit():
+    lst = make_list(1000)
+    edits = [(['cdr'] * (i * 100) + ['car'], -i) for i in range(10)]
+    return lambda: edit(lst, edits)
+
+@benchmark('fold/cons_list_1000')
+def fold_list():
+    lst = make_list(1000)
+    algebra = {Cons: lambda node, car, cdr: car + cdr, Nil: lambda node: 0}
+    return lambda: fold(lst, algebra)
+
+@benchmark('fold/cons_list_1000_memo_hash')
+def fold_list_hash():
+    lst = make_list(1000)
+    algebra = {Cons: lambda node, car, cdr: car + cdr, Nil: lambda node: 0}
+    return lambda: fold(lst, algebra, memo='hash')
+
+@benchmark('fold/dag_depth_1000_memo')
+def fold_dag():
+    # Without the memo this would take 2 ** 1000 steps.
+    dag = Nil()
+    for __ in range(1000):
+        dag = Cons(dag, dag)
+    algebra = {Cons: lambda node, car, cdr: car + cdr + 1,
+               Nil: lambda node: 0}
+    return lambda: fold(dag, algebra, memo='identity')
+
+@benchmark('extract_bindings')
+def extract():
+    pattern = [Cons(b('a%d' % i), Cons(tele_re, b('t%d' % i)))
+               for i in range(20)]
+    return lambda: tuple(extract_bindings(pattern))
+
+module_template = '''
+class C{n}(Base):
+    def f{n}(a, b):
+        x = (a + b)
+        if (x > 0):
+            return g(x, y=1)
+        else:
+            return [i for i in a if i]
+        for i in a:
+            x += i
+        assert x, 'msg'
+        return (x.attr % (1, 'two', ))
+'''
+
+def make_module(count):
+    source = 'import os\nfrom os import path as p, sep\n'
+    source += ''.join(module_template.format(n=n) for n in range(count))
+    return ast.parse(source)
+
+@benchmark('ast2py/module_200_classes')
+def unparse():
+    module = make_module(200)
+    return lambda: ast2py.Unparser().unparse(module)
+
+@benchmark('ast2py/module_200_classes_one_edit')
+def unparse_edited():
+    # Re-render after replacing one statement.
+    module = make_module(200)
+    unparser = ast2py.Unparser()
+    unparser.unparse(module)
+    function = module.body[100].body[0]
+    def run():
+        function.body[0] = ast.parse('x = (a + 2)').body[0]
+        unparser.unparse(module)
+    return run
+
+class Sample(List):
+    count = Require(int)
+    mean = Require(float)
+    name = Require(str)
+
+def make_samples(length):
+    # Short enough for pickle, which recurses into the list.
+    lst = Nil()
+    for i in range(length):
+        lst = Cons(Sample(i, i / 3, 'sample%d' % i), lst)
+    return lst
+
+schema = Schema(List)
+samples = make_samples(100)
+
+@benchmark('serialize/encode_100')
+def serialize_encode():
+    return lambda: schema.dumps(samples)
+
+@benchmark('serialize/decode_100')
+def serialize_decode():
+    data = schema.dumps(samples)
+    return lambda: schema.loads(data)
+
+sized_schema = Schema(List, sized=True)
+
+@benchmark('serialize/view_first_100')
+def serialize_view():
+    # Only the first element is decoded.
+    data = sized_schema.dumps(samples)
+    return lambda: sized_schema.view(data).car.name
+
+@benchmark('serialize/pickle_dumps_100')
+def serialize_pickle_dumps():
+    return lambda: pickle.dumps(samples, pickle.HIGHEST_PROTOCOL)
+
+@benchmark('serialize/pickle_loads_100')
+def serialize_pickle_loads():
+    data = pickle.dumps(samples, pickle.HIGHEST_PROTOCOL)
+    return lambda: pickle.loads(data)
+
+def encoded_sizes():
+    return OrderedDict([
+        ('schema', len(schema.dumps(samples))),
+        ('pickle', len(pickle.dumps(samples, pickle.HIGHEST_PROTOCOL)))])
+
+class Length(MatchCases):
+    def nil(match: Nil):
+        return 0
+    def cons(match: Cons(b(''), b('tail'))):
+        return 1 + Length(tail)
+
+def scaling(max_workers):
+    """Time MatchCases.parallel_map over a batch of values with
+    from 1 to 'max_workers' processes.
+    """
+    values = [make_list(200) for __ in range(2000)]
+    start = perf_counter()
+    serial = [Length(value) for value in values]
+    print('%-36s %12s' % ('parallel/serial', format_time(perf_counter() - start)))
+    for workers in range(1, max_workers + 1):
+        start = perf_counter()
+        assert Length.parallel_map(values, workers=workers,
+                                   chunksize=100) == serial
+        print('%-36s %12s' % ('parallel/workers_%d' % workers,
+                              format_time(perf_counter() - start)))
+
+def bytes_per_instance(variant, count=100000):
+    """Measure the memory allocated per instance of 'variant'."""
+    nil = Nil()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        instances = [variant(1, nil) for __ in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del instances
+    return (after - before) / count
+
+def calibrate(func, min_time):
+    """Return the number of loops needed to run for 'min_time'."""
+    loops = 1
+    while True:
+        start = perf_counter()
+        for __ in range(loops):
+            func()
+        if perf_counter() - start >= min_time:
+            return loops
+        loops *= 2
+
+def run_benchmark(setup, samples, min_time):
+    func = setup()
+    loops = calibrate(func, min_time)
+    timings = []
+    for __ in range(samples):
+        start = perf_counter()
+        for __ in range(loops):
+            func()
+        timings.append((perf_counter() - start) / loops)
+    return {'loops': loops,
+            'samples': timings,
+            'mean': statistics.mean(timings),
+            'stdev': statistics.stdev(timings) if samples > 1 else 0.0}
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.2f %s' % (seconds / scale, unit)
+    return '%.0f ns' % (seconds / 1e-9)
+
+def run(names, samples, min_time):
+    results = OrderedDict()
+    for name, setup in benchmarks.items():
+        if names and not any(n in name for n in names):
+            continue
+        result = results[name] = run_benchmark(setup, samples, min_time)
+        print('%-36s %12s +- %s' % (name, format_time(result['mean']),
+                                    format_time(result['stdev'])))
+    memory = OrderedDict((variant.__name__, bytes_per_instance(variant))
+                         for variant in (Cons, DictCons))
+    for name, size in memory.items():
+        print('%-36s %9.1f bytes' % ('memory/' + name, size))
+    sizes = encoded_sizes()
+    for name, size in sizes.items():
+        print('%-36s %9d bytes' % ('serialize/size_' + name, size))
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'benchmarks': results,
+            'bytes_per_instance': memory,
+            'encoded_bytes': sizes}
+
+def compare(old, new, threshold):
+    """Print the change in each benchmark found in both runs and
+    return the names of those that slowed down by more than
+    'threshold' (a fraction) and by more than their noise.
+    """
+    regressions = []
+    for name, result in new['benchmarks'].items():
+        if name not in old['benchmarks']:
+            continue
+        before = old['benchmarks'][name]
+        change = result['mean'] / before['mean'] - 1
+        noise = (before['stdev'] + result['stdev']) / before['mean']
+        flag = ''
+        if change > threshold and change > noise:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-36s %12s -> %-12s %+7.1f%%%s' %
+              (name, format_time(before['mean']),
+               format_time(result['mean']), change * 100, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-b', '--benchmark', action='append', default=[],
+                        help='only run benchmarks whose names contain this')
+    parser.add_argument('-o', '--output', help='write the results to a file')
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--min-time', type=float, default=0.02,
+                        help='minimum seconds per sample')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--scaling', type=int, metavar='N',
+                        help='time MatchCases.parallel_map with 1 to N '
+                        'processes instead')
+    parser.add_argument('--profile', action='store_true',
+                        help='print profile statistics for the matches '
+                        'made by the benchmarks instead')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown that counts as a regression')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        old, new = (json.load(open(path)) for path in args.compare)
+        regressions = compare(old, new, args.threshold)
+        if regressions:
+            print('%d regression(s)' % len(regressions))
+            return 1
+        return 0
+
+    if args.scaling:
+        scaling(args.scaling)
+        return 0
+
+    if args.profile:
+        with profile() as stats:
+            for name, setup in benchmarks.items():
+                if not args.benchmark or any(n in name
+                                             for n in args.benchmark):
+                    setup()()
+        print(stats.report())
+        return 0
+
+    results = run(args.benchmark, args.samples, args.min_time)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
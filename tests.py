@@ -14,7 +14,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import re
+import ast
+import io
+import os
+import json
+import pickle
 import adt
+import adtcodec
+import ast2py
 
 class TestSingleton(unittest.TestCase):
     def test_singleton(self):
@@ -135,5 +143,1453 @@ class TestADTBase(unittest.TestCase):
         for b in (adt.Binding('foo'), adt.BindingRest('bar'), adt.Binding('')):
             Variant(b)
 
+class List(adt.ADT):
+    pass
+
+class Nil(List):
+    pass
+
+class Cons(List):
+    car = adt.Anything()
+    cdr = adt.Require(List)
+
+def interpret(pattern, value):
+    """Match using the original visitor for comparison."""
+    fields, values = adt.unzip(adt.dispatch(pattern, adt.MatchVisitor(value)))
+    return dict(zip(fields, values))
+
+class TestCompilePattern(unittest.TestCase):
+    b = adt.Binding
+
+    def patterns_and_values(self):
+        b = self.b
+        lst = Cons(1, Cons('two', Nil()))
+        return [
+            (b('x'), 42),
+            (Cons, lst),
+            (Cons(b('a'), Cons(b('b'), b('c'))), lst),
+            (Cons(1, b('rest')), lst),
+            (re.compile(r'(?P<first>\w+) (?P<last>\w+)'), 'John Smith'),
+            ({'a': b('a'), 'b': Cons}, {'a': 1, 'b': lst, 'c': 3}),
+            ([1, b('x'), (b('y'), 3)], (1, 2, [2, 3])),
+            (('a', 'b'), 'ab'),
+            (None, None),
+        ]
+
+    def test_agrees_with_visitor(self):
+        for pattern, value in self.patterns_and_values():
+            compiled = adt.compile_pattern(pattern)
+            self.assertEqual(compiled.match(value)._asdict(),
+                             interpret(pattern, value))
+
+    def test_reusable(self):
+        compiled = adt.compile_pattern(Cons(self.b('a'), Nil()))
+        self.assertEqual(compiled.match(Cons(1, Nil())).a, 1)
+        self.assertEqual(compiled.match(Cons(2, Nil())).a, 2)
+
+    def test_failures(self):
+        compiled = adt.compile_pattern(Cons(1, self.b('a')))
+        for value in (Nil(), Cons(2, Nil()), 'foo'):
+            with self.assertRaises(adt.MatchFailed):
+                compiled.match(value)
+        with self.assertRaises(adt.MatchFailed):
+            adt.compile_pattern([1, 2]).match([1, 2, 3])
+
+    def test_generic_type_rejected_at_compile_time(self):
+        with self.assertRaises(TypeError):
+            adt.compile_pattern(List)
+
+    def test_match_caches_patterns(self):
+        for pattern in (Cons(self.b('a'), Nil()), [self.b('a')]):
+            self.assertIs(adt.cached_compile(pattern),
+                          adt.cached_compile(pattern))
+
+    def test_changed_patterns_are_recompiled(self):
+        b = self.b
+        pattern = {'type': 'click', 'x': b('x')}
+        self.assertEqual(adt.match(pattern, {'type': 'click', 'x': 1}), (1,))
+        pattern['type'] = 'key'
+        with self.assertRaises(adt.MatchFailed):
+            adt.match(pattern, {'type': 'click', 'x': 2})
+        nested = Cons([b('a')], Nil())
+        adt.match(nested, Cons([1], Nil()))
+        nested.car.append(b('b'))
+        self.assertEqual(adt.match(nested, Cons([1, 2], Nil())), (1, 2))
+        node = adt.ast_kwargs(ast.Name, id='x', ctx=b(''))
+        adt.match(node, ast.Name(id='x', ctx=ast.Load()))
+        node.id = 'y'
+        with self.assertRaises(adt.MatchFailed):
+            adt.match(node, ast.Name(id='x', ctx=ast.Load()))
+
+    def test_iterator_patterns(self):
+        b = self.b
+        self.assertEqual(adt.match((x for x in [1, b('y')]), [1, 2]), (2,))
+        pattern = Cons(iter([b('a'), b('b')]), Nil())
+        self.assertEqual(adt.match(pattern, Cons((1, 2), Nil())), (1, 2))
+
+class TestCompileIterative(unittest.TestCase):
+    b = adt.Binding
+    patterns_and_values = TestCompilePattern.patterns_and_values
+
+    def test_agrees_with_closures(self):
+        b = self.b
+        extra = [(ast.parse('x + 1', mode='eval').body,
+                  ast.parse('x + 1', mode='eval').body),
+                 ([0, b('a'), adt.BindingRest('rest')], range(5)),
+                 ([0, b('a'), adt.BindingRest('')], range(5))]
+        for pattern, value in self.patterns_and_values() + extra:
+            expected = adt.compile_pattern(pattern).match(value)
+            result = adt.compile_iterative(pattern).match(value)
+            self.assertEqual(result._fields, expected._fields)
+            self.assertEqual([list(v) if hasattr(v, '__next__') else v
+                              for v in result],
+                             [list(v) if hasattr(v, '__next__') else v
+                              for v in expected])
+
+    def test_failures(self):
+        b = self.b
+        for pattern, value in [(Cons(1, b('a')), Cons(2, Nil())),
+                               ([1, 2], [1, 2, 3]),
+                               ([1, 2], [1]),
+                               ({'a': 1}, {'b': 1}),
+                               (re.compile('a'), 'b'),
+                               (Cons, Nil())]:
+            with self.assertRaises(adt.MatchFailed):
+                adt.compile_iterative(pattern).match(value)
+
+    def test_deep_patterns(self):
+        pattern = Nil()
+        value = Nil()
+        for i in range(10000):
+            pattern = Cons(self.b('x%d' % i) if i % 1000 == 0 else i,
+                           pattern)
+            value = Cons(i, value)
+        compiled = adt.compile_pattern(pattern)
+        self.assertEqual(compiled.match(value), tuple(range(9000, -1, -1000)))
+        with self.assertRaises(adt.MatchFailed):
+            compiled.match(value._replace(cdr=Nil()))
+
+class TestCapturedValuesType(unittest.TestCase):
+    def test_results_share_a_class(self):
+        b = adt.Binding
+        r1 = adt.match(Cons(b('a'), b('b')), Cons(1, Nil()))
+        r2 = adt.match([b('a'), b('b')], [2, 3])
+        self.assertIs(type(r1), type(r2))
+        self.assertEqual(r2, (2, 3))
+
+    def test_cache_counts_hits(self):
+        before = adt.captured_values_type.cache_info()
+        adt.captured_values_type(('x', 'y'))
+        adt.captured_values_type(('x', 'y'))
+        after = adt.captured_values_type.cache_info()
+        self.assertGreaterEqual(after.hits, before.hits + 1)
+
+class TestClosureCases(unittest.TestCase):
+    def test_case_closing_over_locals(self):
+        offset = 10
+        class Sum(adt.MatchCases):
+            def cons(match: Cons(adt.Binding('head'), adt.Binding('tail'))):
+                return head + offset + Sum(tail)
+            def nil(match: Nil):
+                return 0
+        self.assertEqual(Sum(Cons(1, Cons(2, Nil()))), 23)
+
+class TestMatchFailed(unittest.TestCase):
+    class Unprintable:
+        def __init__(self):
+            self.reprs = 0
+        def __repr__(self):
+            self.reprs += 1
+            return 'Unprintable()'
+
+    def test_message_is_formatted_lazily(self):
+        value = self.Unprintable()
+        with self.assertRaises(adt.MatchFailed) as context:
+            adt.match(Cons(1, Nil()), Cons(value, Nil()))
+        self.assertEqual(value.reprs, 0)
+        self.assertEqual(str(context.exception),
+                         "Unprintable() didn't match 1")
+        self.assertEqual(value.reprs, 1)
+
+    def test_plain_messages(self):
+        self.assertEqual(str(adt.MatchFailed('oops')), 'oops')
+        self.assertEqual(str(adt.MatchFailed()), '')
+
+    def test_deep_value_fails_without_repr(self):
+        deep = Nil()
+        for i in range(10000):
+            deep = Cons(i, deep)
+        with self.assertRaises(adt.MatchFailed):
+            adt.match(Cons('x', adt.Binding('rest')), deep)
+
+class TestMatchCasesDispatch(unittest.TestCase):
+    def test_first_match_wins_across_types(self):
+        b = adt.Binding
+        class Describe(adt.MatchCases):
+            def one(match: Cons(1, b('tail')), bindings):
+                return 'one'
+            def nil(match: Nil, bindings):
+                return 'nil'
+            def anything_int(match: b('x'), bindings):
+                return 'other'
+            def cons(match: Cons, bindings):
+                return 'cons'
+
+        self.assertEqual(Describe(Cons(1, Nil())), 'one')
+        self.assertEqual(Describe(Cons(2, Nil())), 'other')
+        self.assertEqual(Describe(Nil()), 'nil')
+        self.assertEqual(Describe(5), 'other')
+
+    def test_classes_with_custom_instance_checks(self):
+        # Like the deprecated ast.Str, which ast.Constant
+        # instances are instances of without being a subclass.
+        class Meta(type):
+            def __instancecheck__(cls, instance):
+                return isinstance(instance, ast.Constant)
+        class Literal(ast.AST, metaclass=Meta):
+            _fields = ('value',)
+        class Describe(adt.MatchCases):
+            def literal(match: Literal, bindings):
+                return bindings.value
+        self.assertIsNone(adt.compile_pattern(Literal).guard)
+        self.assertEqual(Describe(ast.Constant('x')), 'x')
+
+    def test_candidates_by_type(self):
+        class Kind(adt.MatchCases):
+            def nil(match: Nil, bindings):
+                return 'nil'
+            def cons(match: Cons, bindings):
+                return 'cons'
+            def seq(match: [adt.BindingRest('')], bindings):
+                return 'seq'
+
+        self.assertEqual(Kind(Nil()), 'nil')
+        self.assertEqual(Kind(Cons(1, Nil())), 'cons')
+        self.assertEqual(Kind([1, 2]), 'seq')
+        self.assertEqual([case.name for case in Kind._case_table[Cons]],
+                         ['cons', 'seq'])
+        self.assertEqual([case.name for case in Kind._case_table[list]],
+                         ['seq'])
+        with self.assertRaises(adt.CasesExhausted):
+            Kind(42)
+
+class TestDispatch(unittest.TestCase):
+    class Kinds:
+        def __getattr__(self, kind):
+            return lambda pattern: kind
+
+    def test_kinds(self):
+        kinds = self.Kinds()
+        for pattern, kind in [
+                (adt.Binding('a'), 'binding'),
+                (Cons, 'adt_constructor'),
+                (Nil(), 'adt_instance'),
+                (ast.Name, 'ast_constructor'),
+                (ast.Pass(), 'ast_instance'),
+                (re.compile('a'), 'regexp'),
+                ('abc', 'literal'),
+                ({}, 'mapping'),
+                ([], 'sequence'),
+                (42, 'literal'),
+                (int, 'literal')]:
+            self.assertEqual(adt.dispatch(pattern, kinds), kind)
+
+    def test_generic_type(self):
+        with self.assertRaises(TypeError):
+            adt.dispatch(List, self.Kinds())
+
+    def test_register_pattern_kind(self):
+        class Pair:
+            def __init__(self, first, second):
+                self.items = (first, second)
+            def __iter__(self):
+                return iter(self.items)
+        self.assertEqual(adt.dispatch(Pair(1, 2), self.Kinds()), 'sequence')
+        adt.register_pattern_kind(Pair, 'literal')
+        try:
+            self.assertEqual(adt.dispatch(Pair(1, 2), self.Kinds()),
+                             'literal')
+        finally:
+            del adt._registered_kinds[Pair]
+            adt._pattern_kinds.clear()
+
+class TestSlots(unittest.TestCase):
+    def test_variants_have_no_dict(self):
+        self.assertFalse(hasattr(Cons(1, Nil()), '__dict__'))
+        self.assertFalse(hasattr(Nil(), '__dict__'))
+
+    def test_variants_can_ask_for_a_dict(self):
+        class Variant(List, slots=False):
+            field = adt.Anything()
+        v = Variant(1)
+        v.extra = 2
+        self.assertEqual(v.extra, 2)
+
+class Point(List):
+    x = adt.Require(int)
+    y = adt.Require(float)
+    label = adt.Anything()
+
+class TestVariantColumns(unittest.TestCase):
+    def test_columns(self):
+        table = adt.VariantColumns(Point, [Point(1, 2.0, 'a')])
+        table.append(3, 4.5, 'b')
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.column('x').typecode, 'q')
+        self.assertEqual(table.column('y').tolist(), [2.0, 4.5])
+        self.assertEqual(table.column('label'), ['a', 'b'])
+
+    def test_views(self):
+        table = adt.VariantColumns(Point, [Point(1, 2.0, 'a'),
+                                           Point(3, 4.5, 'b')])
+        view = table[-1]
+        self.assertEqual((view.x, view[1], view.label), (3, 4.5, 'b'))
+        self.assertEqual(tuple(view), (3, 4.5, 'b'))
+        self.assertEqual(view.materialize(), Point(3, 4.5, 'b'))
+        self.assertEqual([v.x for v in table], [1, 3])
+        with self.assertRaises(IndexError):
+            table[2]
+
+    def test_constraints_checked(self):
+        table = adt.VariantColumns(Point)
+        with self.assertRaises(TypeError):
+            table.append('1', 2.0, None)
+        with self.assertRaises(TypeError):
+            table.extend([Cons(1, Nil())])
+
+    def test_values_that_dont_fit_an_array(self):
+        table = adt.VariantColumns(Point)
+        table.append(True, 1.0, None)
+        table.append(2**70, 1.0, None)
+        self.assertEqual(table.column('x'), [True, 2**70])
+        self.assertIs(table[0].x, True)
+
+class Tree(adt.ADT):
+    pass
+
+class Leaf(Tree, intern=True):
+    value = adt.Anything()
+
+class Node(Tree, intern=True):
+    left = adt.Require(Tree)
+    right = adt.Require(Tree)
+
+class TestInterning(unittest.TestCase):
+    def test_equal_instances_are_shared(self):
+        self.assertIs(Node(Leaf(1), Leaf(2)), Node(Leaf(1), Leaf(2)))
+        self.assertIs(Leaf(value=1), Leaf(1))
+        self.assertIsNot(Leaf(1), Leaf(1.0))
+        self.assertIsNot(Leaf(1), Leaf(2))
+
+    def test_equality_and_hashing(self):
+        tree = Node(Leaf(1), Leaf(2))
+        self.assertEqual(tree, Node(Leaf(1), Leaf(2)))
+        self.assertNotEqual(tree, Node(Leaf(2), Leaf(1)))
+        self.assertEqual(hash(tree), hash((Leaf(1), Leaf(2))))
+        self.assertEqual(tree, (Leaf(1), Leaf(2)))
+        self.assertEqual(tree._replace(right=Leaf(1)),
+                         Node(Leaf(1), Leaf(1)))
+        self.assertIs(tree._replace(right=Leaf(1)), Node(Leaf(1), Leaf(1)))
+
+    def test_equal_across_field_types(self):
+        # Like plain variants and tuples, 1, 1.0 and True are equal.
+        self.assertEqual(Leaf(1), Leaf(1.0))
+        self.assertEqual(Leaf(1), Leaf(True))
+        self.assertEqual(Leaf(1), Cons(1, Nil())[:1])
+        self.assertEqual(Node(Leaf(1), Leaf(2)), Node(Leaf(1.0), Leaf(2)))
+        self.assertNotEqual(Leaf(1), Leaf(1.5))
+        self.assertIn(Leaf(1.0), {Leaf(1)})
+        # Equal, but not the same value.
+        node = Node(Leaf(1.0), Leaf(True))
+        self.assertIsNot(node, Node(Leaf(1), Leaf(1)))
+        self.assertIs(type(node.left.value), float)
+        self.assertIs(node, Node(Leaf(1.0), Leaf(True)))
+
+    def test_nested_field_types(self):
+        # Plain variants and tuples in fields don't hide their types.
+        class Boxed(adt.ADT):
+            pass
+        class Box(Boxed, intern=True):
+            value = adt.Anything()
+        pairs = [(Cons(1.0, Nil()), Cons(1, Nil())), ((1.0,), (1,)),
+                 (frozenset([True]), frozenset([1]))]
+        for value, equal in pairs:
+            box = Box(value)
+            self.assertIsNot(box, Box(equal))
+            self.assertEqual(box, Box(equal))
+            self.assertIs(box, Box(value))
+        self.assertIs(type(Box((1.0,)).value[0]), float)
+        self.assertIs(type(Box(Cons(1, Nil())).value.car), int)
+
+    def test_unhashable_values_are_not_shared(self):
+        self.assertIsNot(Leaf([1]), Leaf([1]))
+        self.assertEqual(Leaf([1]), Leaf([1]))
+
+    def test_constraints_checked(self):
+        with self.assertRaises(TypeError):
+            Node(1, 2)
+        self.assertEqual(len([n for n in Node._interned.values()
+                              if n.left == 1]), 0)
+
+    def test_memory_is_reclaimed(self):
+        import gc
+        Leaf('reclaimed')
+        gc.collect()
+        self.assertNotIn((('reclaimed',), (str,)), Leaf._interned)
+
+class TestConstruction(unittest.TestCase):
+    def test_keyword_arguments(self):
+        self.assertEqual(Point(y=1.0, x=2, label=None), Point(2, 1.0, None))
+        with self.assertRaises(TypeError):
+            Point(x='2', y=1.0, label=None)
+
+    def test_custom_constraints(self):
+        class Positive(adt.Constraint):
+            def check(self, value):
+                if value <= 0:
+                    raise ValueError(value)
+        class Variant(List):
+            field = Positive()
+        Variant(1)
+        Variant(adt.Binding('x'))
+        with self.assertRaises(ValueError):
+            Variant(-1)
+
+    def test_from_columns(self):
+        points = Point.from_columns([1, 2], adt.array('d', [1.5, 2.5]),
+                                    ['a', None])
+        self.assertEqual(points, [Point(1, 1.5, 'a'), Point(2, 2.5, None)])
+        self.assertIs(type(points[0]), Point)
+        with self.assertRaises(TypeError):
+            Point.from_columns([1, 2.0], [1.0, 2.0], [None, None])
+        with self.assertRaises(ValueError):
+            Point.from_columns([1, 2], [1.0], [None, None])
+
+    def test_bulk(self):
+        self.assertEqual(Point.bulk([(1, 2.0, 'a'), (3, 4.0, 'b')]),
+                         [Point(1, 2.0, 'a'), Point(3, 4.0, 'b')])
+        self.assertEqual(Point.bulk([]), [])
+        with self.assertRaises(TypeError):
+            Point.bulk([(1, 2.0)])
+        self.assertIs(Leaf.bulk([(1,)])[0], Leaf(1))
+
+class TestUnchecked(unittest.TestCase):
+    def test_unchecked(self):
+        with adt.unchecked():
+            self.assertEqual(Point('x', 'y', None).x, 'x')
+            self.assertEqual(Point.from_columns(['x'], ['y'], [None]),
+                             [Point('x', 'y', None)])
+            Node(1, 2)
+        with self.assertRaises(TypeError):
+            Point('x', 'y', None)
+        self.assertTrue(adt.checking.enabled)
+
+    def test_unchecked_variant(self):
+        class Fast(List, check=False):
+            value = adt.Require(int)
+        self.assertEqual(Fast('x').value, 'x')
+        self.assertEqual(Fast.bulk([('x',)]), [Fast('x')])
+
+class TestBindingArguments(unittest.TestCase):
+    def test_closure_over_the_class(self):
+        b = adt.Binding
+        class Length(adt.MatchCases):
+            def nil(match: Nil):
+                return 0
+            def cons(match: Cons(b(''), b('tail'))):
+                return 1 + Length(tail)
+        self.assertEqual(Length(Cons(1, Cons(2, Nil()))), 2)
+
+    def test_no_source_needed(self):
+        env = {'Cons': Cons, 'b': adt.Binding}
+        exec("def first(match: Cons(b('head'), b('')) ):\n"
+             "    return head\n", env)
+        First = adt.MatchCasesMeta('First', (adt.MatchCases,),
+                                   {'first': env['first']})
+        self.assertEqual(First(Cons(1, Nil())), 1)
+
+    def test_global_writes(self):
+        global case_counter
+        case_counter = 0
+        class Count(adt.MatchCases):
+            def cons(match: Cons(adt.Binding('head'), adt.Binding(''))):
+                global case_counter
+                case_counter += head
+        Count(Cons(2, Nil()))
+        Count(Cons(3, Nil()))
+        self.assertEqual(case_counter, 5)
+
+    def test_binding_shadows_closure(self):
+        head = 'closure'
+        class First(adt.MatchCases):
+            def cons(match: Cons(adt.Binding('head'), adt.Binding(''))):
+                return (head, 2)
+        self.assertEqual(First(Cons('binding', Nil())), ('binding', 2))
+        self.assertEqual(head, 'closure')
+
+    def test_defaults_and_doc(self):
+        class Scale(adt.MatchCases):
+            def cons(match: Cons(adt.Binding('head'), adt.Binding('')), *,
+                     scale=10):
+                "Scale the head."
+                return head * scale
+        self.assertEqual(Scale(Cons(2, Nil())), 20)
+        self.assertEqual(Scale._cases[0].action.__doc__, 'Scale the head.')
+        env = {'Cons': Cons, 'b': adt.Binding}
+        exec("def first(match: Cons(b('head'), b('')), *, scale=3):\n"
+             "    return head * scale\n", env)
+        First = adt.MatchCasesMeta('First', (adt.MatchCases,),
+                                   {'first': env['first']})
+        self.assertEqual(First(Cons(2, Nil())), 6)
+
+    def test_traceback_lines(self):
+        class Fail(adt.MatchCases):
+            def cons(match: Cons(adt.Binding('head'), adt.Binding(''))):
+                raise ValueError(head)
+        try:
+            Fail(Cons(1, Nil()))
+        except ValueError as error:
+            traceback = error.__traceback__
+        while traceback.tb_next is not None:
+            traceback = traceback.tb_next
+        self.assertEqual(traceback.tb_frame.f_code.co_filename, __file__)
+        with open(__file__) as source:
+            line = source.readlines()[traceback.tb_lineno - 1]
+        self.assertIn('raise ValueError(head)', line)
+
+    def test_no_source_global_writes_refused(self):
+        env = {'Cons': Cons, 'b': adt.Binding}
+        exec("def first(match: Cons(b('head'), b('')) ):\n"
+             "    global total\n"
+             "    total = head\n", env)
+        with self.assertRaises(TypeError):
+            adt.MatchCasesMeta('First', (adt.MatchCases,),
+                               {'first': env['first']})
+
+    def test_assigned_bindings(self):
+        b = adt.Binding
+        class Double(adt.MatchCases):
+            def cons(match: Cons(b('head'), b(''))):
+                head *= 2
+                return head
+        self.assertEqual(Double(Cons(2, Nil())), 4)
+
+    def test_code_cache(self):
+        import tempfile, os
+        b = adt.Binding
+        def make():
+            class Double(adt.MatchCases):
+                def cons(match: Cons(b('head'), b(''))):
+                    head *= 2
+                    return head
+            return Double
+        with tempfile.TemporaryDirectory() as cache:
+            adt.MatchCasesMeta.code_cache = cache
+            try:
+                make()
+                self.assertEqual(len(os.listdir(cache)), 1)
+                getsource = adt.inspect.getsource
+                adt.inspect.getsource = None
+                try:
+                    self.assertEqual(make()(Cons(3, Nil())), 6)
+                finally:
+                    adt.inspect.getsource = getsource
+            finally:
+                adt.MatchCasesMeta.code_cache = None
+
+class Sum(adt.MatchCases):
+    def nil(match: Nil):
+        return 0
+    def cons(match: Cons(adt.Binding('head'), adt.Binding('tail'))):
+        return head + Sum(tail)
+
+class TestParallelMap(unittest.TestCase):
+    def test_results_in_order(self):
+        lists = [Nil()]
+        for i in range(50):
+            lists.append(Cons(i, lists[-1]))
+        self.assertEqual(Sum.parallel_map(lists, workers=2, chunksize=7),
+                         [Sum(lst) for lst in lists])
+
+    def test_exceptions(self):
+        with self.assertRaises(adt.CasesExhausted):
+            Sum.parallel_map([Nil(), 1], workers=2)
+
+class TestStreaming(unittest.TestCase):
+    values = [Cons(1, Nil()), Nil(), Cons(2, Nil()), 3]
+
+    def test_match_iter(self):
+        pattern = Cons(adt.Binding('x'), Nil())
+        self.assertEqual([r.x for r in adt.match_iter(pattern, self.values)],
+                         [1, 2])
+        results = list(adt.match_iter(pattern, self.values,
+                                      on_failure='yield'))
+        self.assertEqual(len(results), 4)
+        self.assertIsInstance(results[1], adt.MatchFailed)
+        self.assertEqual(results[2].x, 2)
+
+    def test_raise_after_earlier_results(self):
+        results = adt.match_iter(Cons, self.values, on_failure='raise')
+        self.assertEqual(next(results).car, 1)
+        with self.assertRaises(adt.MatchFailed):
+            next(results)
+
+    def test_results_are_not_held_back(self):
+        read = []
+        def values():
+            for value in self.values:
+                read.append(value)
+                yield value
+        results = adt.match_iter(Cons(adt.Binding('x'), Nil()), values())
+        self.assertEqual(next(results).x, 1)
+        self.assertEqual(len(read), 1)
+
+    def test_skipped_values_are_not_described(self):
+        described = []
+        class Value:
+            def __repr__(self):
+                described.append(self)
+                return 'Value()'
+        results = Sum.map([Nil(), Value(), Value()])
+        self.assertEqual(list(results), [0])
+        self.assertEqual(described, [])
+        failures = list(Sum.map([Value()], on_failure='yield'))
+        self.assertIn('no case for Value() in', str(failures[0]))
+        self.assertIn('no case for Value() in',
+                      str(pickle.loads(pickle.dumps(failures[0]))))
+
+    def test_unbounded(self):
+        from itertools import count, islice
+        values = (Cons(i, Nil()) for i in count())
+        results = adt.match_iter(Cons(adt.Binding('x'), Nil()), values)
+        self.assertEqual([r.x for r in islice(results, 1000)],
+                         list(range(1000)))
+
+    def test_match_cases_map(self):
+        class Head(adt.MatchCases):
+            def cons(match: Cons, bindings):
+                return bindings.car
+            def nil(match: Nil, bindings):
+                return None
+        self.assertEqual(list(Head.map(self.values)), [1, None, 2])
+        with self.assertRaises(adt.CasesExhausted):
+            list(Head.map(self.values, on_failure='raise'))
+        with self.assertRaises(ValueError):
+            Head.map(self.values, on_failure='ignore')
+
+class TestCodec(unittest.TestCase):
+    schema = adtcodec.Schema(List, Tree, allow_pickle=True)
+
+    def roundtrip(self, value):
+        result = self.schema.loads(self.schema.dumps(value))
+        self.assertEqual(result, value)
+        self.assertIs(type(result), type(value))
+        return result
+
+    def test_roundtrip(self):
+        self.roundtrip(Nil())
+        self.roundtrip(Cons(1, Cons('two', Cons(None, Nil()))))
+        self.roundtrip(Point(-5, 2.5, {'any': [1, 2]}))
+        self.roundtrip(Cons(Point(2**80, 0.0, b'x'), Nil()))
+        self.roundtrip(Cons(True, Cons(Cons(1.5, Nil()), Nil())))
+
+    def test_shared_instances(self):
+        self.assertIs(self.roundtrip(Nil()), Nil())
+        tree = Node(Leaf(1), Node(Leaf(2), Leaf(1)))
+        self.assertIs(self.roundtrip(tree), tree)
+
+    def test_compact(self):
+        self.assertEqual(self.schema.dumps(Cons(1, Nil())),
+                         bytes([1, adtcodec.ANY_INT, 2, 0]))
+        self.assertEqual(len(self.schema.dumps(Point(1, 1.0, None))), 11)
+
+    def test_required_types(self):
+        class Word(adt.ADT):
+            pass
+        class Text(Word):
+            text = adt.Require(str)
+        schema = adtcodec.Schema(Word)
+        self.assertEqual(schema.dumps(Text('caf\xe9')), b'\x00\x05caf\xc3\xa9')
+        self.assertEqual(schema.loads(b'\x00\x05caf\xc3\xa9'), Text('caf\xe9'))
+        with self.assertRaises(TypeError):
+            self.schema.dumps(Text('x'))
+        with adt.unchecked():
+            wrong = Point('1', 1.0, None)
+        with self.assertRaises(TypeError):
+            self.schema.dumps(wrong)
+
+    def test_int_subclasses(self):
+        import enum
+        class Level(enum.IntEnum):
+            HIGH = 3
+        for value in (True, Level.HIGH):
+            result = self.schema.loads(self.schema.dumps(Point(value, 1.0,
+                                                               None)))
+            self.assertIs(type(result.x), int)
+            self.assertEqual(result, Point(int(value), 1.0, None))
+
+    def test_pickle_is_opt_in(self):
+        value = Point(1, 1.0, {'any': 1})
+        schema = adtcodec.Schema(List, Tree)
+        with self.assertRaises(TypeError):
+            schema.dumps(value)
+        with self.assertRaises(adtcodec.DecodeError):
+            schema.loads(self.schema.dumps(value))
+        self.assertEqual(self.schema.loads(self.schema.dumps(value)), value)
+
+    def test_deep(self):
+        lst = Nil()
+        for i in range(100000):
+            lst = Cons(i, lst)
+        # Comparing the lists themselves would recurse.
+        data = self.schema.dumps(lst)
+        self.assertEqual(self.schema.dumps(self.schema.loads(data)), data)
+
+    def test_bad_data(self):
+        data = self.schema.dumps(Cons(1, Nil()))
+        with self.assertRaises(adtcodec.DecodeError):
+            self.schema.loads(data[:-1])
+        with self.assertRaises(adtcodec.DecodeError):
+            self.schema.loads(data + data)
+        with self.assertRaises(adtcodec.DecodeError):
+            self.schema.loads(b'\x7f')
+
+    def test_stream(self):
+        values = [Cons(i, Nil()) for i in range(10)] + [Leaf('x')]
+        out = io.BytesIO()
+        for value in values:
+            self.schema.dump(value, out)
+        out.seek(0)
+        self.assertEqual(list(self.schema.load_iter(out)), values)
+
+class TestCodecViews(unittest.TestCase):
+    schema = adtcodec.Schema(List, Tree, sized=True)
+
+    def test_encode_views(self):
+        value = Cons(Point(1, 2.0, 'p'), Cons(Leaf(3), Nil()))
+        for schema in (self.schema, TestCodec.schema):
+            view = schema.view(schema.dumps(value))
+            self.assertEqual(schema.loads(schema.dumps(view)), value)
+            edited = adt.set_in(view, ['cdr', 'car'], Leaf(4))
+            self.assertIsInstance(edited.car, adtcodec.View)
+            expected = Cons(Point(1, 2.0, 'p'), Cons(Leaf(4), Nil()))
+            for other in (self.schema, TestCodec.schema):
+                self.assertEqual(other.loads(other.dumps(edited)), expected)
+            replaced = view._replace(cdr=view.cdr._replace(car=Leaf(5)))
+            self.assertEqual(schema.loads(schema.dumps(replaced)),
+                             Cons(Point(1, 2.0, 'p'), Cons(Leaf(5), Nil())))
+
+    def test_sized_roundtrip(self):
+        value = Cons(Cons(1, Nil()), Cons(Point(1, 2.0, 'p'), Nil()))
+        for schema in (self.schema, TestCodec.schema):
+            self.assertEqual(schema.loads(schema.dumps(value)), value)
+
+    def test_fields(self):
+        value = Cons(Point(1, 2.0, 'p'), Cons(Leaf(3), Nil()))
+        for schema in (self.schema, TestCodec.schema):
+            view = schema.view(schema.dumps(value))
+            self.assertIsInstance(view, Cons)
+            self.assertIsInstance(view, adtcodec.View)
+            self.assertEqual(view.cdr.car, Leaf(3))
+            self.assertEqual(view[0].label, 'p')
+            self.assertIs(view[-1][-1], Nil())
+            self.assertEqual(len(view), 2)
+            self.assertEqual(view, value)
+            self.assertEqual(value, view)
+            self.assertEqual(repr(view), repr(value))
+            self.assertEqual(view.materialize(), value)
+            self.assertEqual(adt.digest(view), adt.digest(value))
+            self.assertEqual(view._replace(car=0), Cons(0, value.cdr))
+
+    def test_match(self):
+        view = self.schema.view(self.schema.dumps(
+            Cons(1, Cons(2, Nil()))))
+        result = adt.match(Cons(adt.Binding('a'),
+                                Cons(2, adt.Binding('rest'))), view)
+        self.assertEqual((result.a, result.rest), (1, Nil()))
+        with self.assertRaises(adt.MatchFailed):
+            adt.match(Cons(1, Nil()), view)
+        class Head(adt.MatchCases):
+            def cons(match: Cons, bindings):
+                return bindings.car
+        self.assertEqual(Head(view), 1)
+
+    def test_only_used_bytes_are_read(self):
+        data = bytearray(self.schema.dumps(Node(Leaf('left'),
+                                                Leaf('right'))))
+        # Spoil the left subtree.
+        start = data.index(b'left')
+        data[start - 2:start + 4] = b'\xff' * 6
+        view = self.schema.view(data)
+        self.assertEqual(view.right, Leaf('right'))
+        with self.assertRaises(adtcodec.DecodeError):
+            view.left.value
+
+    def test_file(self):
+        import os
+        import tempfile
+        value = Cons('x', Cons(2.5, Nil()))
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(self.schema.dumps(value))
+            view = self.schema.view_file(path)
+            self.assertEqual(view.cdr.car, 2.5)
+            del view
+        finally:
+            os.remove(path)
+
+class Branch(List, slots=False):
+    left = adt.Require(List)
+    right = adt.Require(List)
+
+class TestDigest(unittest.TestCase):
+    def test_structural(self):
+        self.assertEqual(adt.digest(Cons(1, Cons('a', Nil()))),
+                         adt.digest(Cons(1, Cons('a', Nil()))))
+        self.assertNotEqual(adt.digest(Cons(1, Nil())),
+                            adt.digest(Cons(1.0, Nil())))
+        self.assertNotEqual(adt.digest(Cons('ab', Cons('c', Nil()))),
+                            adt.digest(Cons('a', Cons('bc', Nil()))))
+        self.assertNotEqual(adt.digest(Cons([1], Nil())),
+                            adt.digest(Cons([2], Nil())))
+        self.assertTrue(adt.equal(Node(Leaf(1), Leaf(2)),
+                                  Node(Leaf(1), Leaf(2))))
+        self.assertFalse(adt.equal(Cons(1, Nil()), Cons(2, Nil())))
+
+    def test_cached(self):
+        tree = Branch(Branch(Nil(), Cons(1, Nil())), Nil())
+        first = adt.digest(tree)
+        self.assertEqual(tree.__dict__['_digest'], first)
+        self.assertIn('_digest', tree.left.__dict__)
+        # Only the new root is digested after a replace.
+        changed = tree._replace(right=Cons(2, Nil()))
+        self.assertNotIn('_digest', changed.__dict__)
+        self.assertNotEqual(adt.digest(changed), first)
+        self.assertIs(changed.left, tree.left)
+        self.assertEqual(adt.digest(changed), adt.digest(
+            Branch(Branch(Nil(), Cons(1, Nil())), Cons(2, Nil()))))
+
+    def test_deep(self):
+        lst = Nil()
+        for i in range(100000):
+            lst = Cons(i, lst)
+        self.assertEqual(len(adt.digest(lst)), 20)
+
+    def test_containers(self):
+        digest = adt.digest
+        self.assertEqual(digest(Cons(frozenset(['a', 'b', 'c']), Nil())),
+                         digest(Cons(frozenset(['c', 'b', 'a']), Nil())))
+        self.assertEqual(digest(Cons({'x': 1, 'y': [2]}, Nil())),
+                         digest(Cons({'y': [2], 'x': 1}, Nil())))
+        self.assertNotEqual(digest(Cons((1, 2), Nil())),
+                            digest(Cons([1, 2], Nil())))
+        self.assertNotEqual(digest(Cons((1, 2), Nil())),
+                            digest(Cons((2, 1), Nil())))
+        # ADTs inside containers are digested as nodes.
+        tree = Branch(Nil(), Nil())
+        self.assertEqual(digest(Cons([tree], Nil())),
+                         digest(Cons([Branch(Nil(), Nil())], Nil())))
+        self.assertIn('_digest', tree.__dict__)
+        loop = []
+        loop.append(loop)
+        with self.assertRaises(ValueError):
+            digest(Cons(loop, Nil()))
+
+    def test_independent_of_hash_seed(self):
+        import subprocess, sys
+        script = ("import adt, tests; print(adt.digest(tests.Cons("
+                  "frozenset(['a', 'b', 'c', 'd']), tests.Nil())).hex())")
+        digests = {subprocess.check_output(
+            [sys.executable, '-W', 'ignore', '-c', script],
+            env=dict(os.environ, PYTHONHASHSEED=seed)).strip()
+                   for seed in ('1', '2', '3')}
+        self.assertEqual(len(digests), 1)
+
+class TestZipper(unittest.TestCase):
+    def setUp(self):
+        self.lst = Cons(1, Cons(Point(2, 3.0, 'p'), Cons(4, Nil())))
+
+    def test_replace(self):
+        zipper = adt.Zipper(self.lst).down('cdr').down(0).down('x')
+        self.assertEqual(zipper.focus, 2)
+        result = zipper.replace(20).root()
+        self.assertEqual(result, Cons(1, Cons(Point(20, 3.0, 'p'),
+                                              Cons(4, Nil()))))
+        self.assertIs(result.cdr.cdr, self.lst.cdr.cdr)
+        self.assertEqual(self.lst.cdr.car.x, 2)
+
+    def test_moving_without_replacing_shares_everything(self):
+        zipper = adt.Zipper(self.lst).down('cdr').down('cdr')
+        self.assertIs(zipper.up().up().focus, self.lst)
+        self.assertIs(zipper.root(), self.lst)
+
+    def test_replacements_are_checked(self):
+        zipper = adt.Zipper(self.lst).down('cdr')
+        with self.assertRaises(TypeError):
+            zipper.replace(3)
+        with adt.unchecked():
+            self.assertEqual(zipper.replace(3).root(), Cons(1, 3))
+        zipper.replace(adt.Binding('rest'))
+        with self.assertRaises(TypeError):
+            zipper.down('car').down('x').down(0)
+        with self.assertRaises(AttributeError):
+            zipper.down('car').down('car')
+        with self.assertRaises(ValueError):
+            adt.Zipper(self.lst).up()
+
+    def test_unchecked_variants(self):
+        class Loose(List, check=False):
+            n = adt.Require(int)
+        zipper = adt.Zipper(Loose(1)).down('n').replace('x')
+        self.assertEqual(zipper.root(), Loose('x'))
+
+    def test_interned(self):
+        tree = Node(Leaf(1), Node(Leaf(2), Leaf(3)))
+        self.assertIs(adt.set_in(tree, ['right', 'left', 'value'], 1),
+                      Node(Leaf(1), Node(Leaf(1), Leaf(3))))
+
+    def test_edit(self):
+        result = adt.edit(self.lst, [(('car',), 10),
+                                     (('cdr', 'car', 'label'), 'q'),
+                                     (('cdr', 'car', 'y'), 1.5),
+                                     (('cdr', 'cdr'), Nil())])
+        self.assertEqual(result, Cons(10, Cons(Point(2, 1.5, 'q'), Nil())))
+        self.assertEqual(adt.update_in(self.lst, ['car'], lambda x: x + 1),
+                         Cons(2, self.lst.cdr))
+
+    def test_deep(self):
+        lst = Nil()
+        for i in range(10000):
+            lst = Cons(i, lst)
+        path = ['cdr'] * 9000 + ['car']
+        result = adt.set_in(lst, path, 'x')
+        self.assertEqual(adt.Zipper(result).down('car').focus, 9999)
+        zipper = adt.Zipper(result)
+        for field in path:
+            zipper = zipper.down(field)
+        self.assertEqual(zipper.focus, 'x')
+
+class TestFold(unittest.TestCase):
+    sum_list = {Cons: lambda node, car, cdr: car + cdr,
+                Nil: lambda node: 0}
+
+    def test_fold(self):
+        self.assertEqual(adt.fold(Cons(1, Cons(2, Nil())), self.sum_list), 3)
+        lst = Nil()
+        for i in range(100000):
+            lst = Cons(i, lst)
+        self.assertEqual(adt.fold(lst, self.sum_list), sum(range(100000)))
+        with self.assertRaises(TypeError):
+            adt.fold(Cons(Point(1, 1.0, None), Nil()), self.sum_list)
+
+    def test_fold_by_base_class(self):
+        def names(node, *fields):
+            found = set()
+            for field in fields:
+                for item in field if type(field) is list else [field]:
+                    if type(item) is set:
+                        found |= item
+            return found
+        tree = ast.parse('x + f(y, 2)', mode='eval')
+        self.assertEqual(adt.fold(tree, {
+            ast.Name: lambda node, id, ctx: {id},
+            ast.AST: names}), {'x', 'f', 'y'})
+
+    def test_memo(self):
+        calls = []
+        def count(node, left, right):
+            calls.append(node)
+            return left + right
+        algebra = {Node: count, Leaf: lambda node, value: value}
+        tree = Leaf(1)
+        for __ in range(50):
+            tree = Node(tree, tree)
+        self.assertEqual(adt.fold(tree, algebra, memo='identity'), 2 ** 50)
+        self.assertEqual(len(calls), 50)
+        del calls[:]
+        self.assertEqual(adt.fold(tree, algebra, memo='hash'), 2 ** 50)
+        self.assertEqual(len(calls), 50)
+        with self.assertRaises(ValueError):
+            adt.fold(tree, algebra, memo='id')
+
+    def test_memo_hash(self):
+        calls = []
+        def count(node, *fields):
+            calls.append(node)
+            return node
+        algebra = {adt.ADT: count}
+        # Equal subtrees that aren't the same object are combined once,
+        # but fields of different types keep them apart.
+        tree = Node(Node(Leaf(1), Leaf(1)), Node(Leaf(1.0), Leaf(True)))
+        adt.fold(tree, algebra, memo='hash')
+        self.assertEqual([type(node.value) for node in calls
+                          if type(node) is Leaf], [int, float, bool])
+        self.assertEqual(len(calls), 6)
+        lst = Nil()
+        for i in range(20000):
+            lst = Cons(i % 10, lst)
+        del calls[:]
+        adt.fold(lst, algebra, memo='hash')
+        self.assertEqual(len(calls), 20001)
+        results = adt.fold(Cons([1], Cons([1], Nil())),
+                           {Cons: lambda node, car, cdr: (car, cdr),
+                            Nil: lambda node: None}, memo='hash')
+        self.assertEqual(results, ([1], ([1], None)))
+        self.assertIsNot(results[0], results[1][0])
+        # AST nodes are only equal to themselves.
+        tree = ast.parse('a; a')
+        names = []
+        adt.fold(tree, {ast.AST: lambda node, *fields: node,
+                        ast.Name: lambda node, *fields: names.append(node)},
+                 memo='hash')
+        self.assertEqual(len(names), 2)
+
+    def test_transform(self):
+        lst = Cons(1, Cons(-2, Cons([3], Nil())))
+        double = {Cons: lambda node: node._replace(car=node.car * 2)}
+        self.assertEqual(adt.transform(lst, double),
+                         Cons(2, Cons(-4, Cons([3, 3], Nil()))))
+        drop_negative = {Cons: lambda node: node.cdr
+                         if isinstance(node.car, int) and node.car < 0
+                         else node}
+        result = adt.transform(lst, drop_negative, memo='hash')
+        self.assertEqual(result, Cons(1, Cons([3], Nil())))
+        self.assertIs(result.cdr, lst.cdr.cdr)
+        self.assertIs(adt.transform(lst, {}), lst)
+        with self.assertRaises(TypeError):
+            adt.transform(lst, {Nil: lambda node: 1})
+
+    def test_transform_unchecked_variants(self):
+        class Loose(List, check=False):
+            n = adt.Require(int)
+        result = adt.transform(Loose(Leaf(1)), {Leaf: lambda node: 'x'})
+        self.assertEqual(result, Loose('x'))
+
+    def test_transform_ast(self):
+        tree = ast.parse('x = a + 1\ny = a', mode='exec')
+        rename = {ast.Name: lambda node: ast.Name(id='b', ctx=node.ctx)
+                  if node.id == 'a' else node}
+        result = adt.transform(tree, rename)
+        self.assertEqual(ast.dump(result), ast.dump(
+            ast.parse('x = b + 1\ny = b', mode='exec')))
+        self.assertEqual(result.body[0].lineno, 1)
+        self.assertIs(result.body[0].targets, tree.body[0].targets)
+        self.assertEqual(ast.dump(tree), ast.dump(
+            ast.parse('x = a + 1\ny = a', mode='exec')))
+
+class TestUnparse(unittest.TestCase):
+    source = ("import os\n"
+              "class C(Base):\n"
+              "    def f(a, b):\n"
+              "        x = (a + b)\n"
+              "        if (x > 0):\n"
+              "            return g(x, y=1)\n"
+              "        else:\n"
+              "            pass\n"
+              "        return x\n")
+
+    def test_unparse(self):
+        tree = ast.parse(self.source)
+        self.assertEqual(ast2py.unparse(tree), self.source)
+        self.assertEqual('\n'.join(ast2py.MatchMod(tree)) + '\n',
+                         self.source)
+        out = io.StringIO()
+        ast2py.unparse(tree.body[1].body[0].body[1], out)
+        self.assertEqual(out.getvalue(), "if (x > 0):\n"
+                                         "    return g(x, y=1)\n"
+                                         "else:\n"
+                                         "    pass\n")
+        self.assertEqual(ast2py.unparse(ast.parse('a.b', mode='eval').body),
+                         'a.b\n')
+
+    def test_only_new_statements_are_rendered(self):
+        tree = ast.parse(self.source)
+        unparser = ast2py.Unparser()
+        unparser.unparse(tree)
+        function = tree.body[1].body[0]
+        if_entry = unparser.cache[id(function.body[1])]
+        function.body[0] = ast.parse('x = (a + 2)').body[0]
+        unparser.invalidate(function)
+        self.assertEqual(unparser.unparse(tree),
+                         self.source.replace('(a + b)', '(a + 2)'))
+        # The if statement was reused rather than rendered again.
+        self.assertIs(unparser.cache[id(function.body[1])], if_entry)
+
+    def test_changes_in_place_are_rendered(self):
+        tree = ast.parse(self.source)
+        unparser = ast2py.Unparser()
+        unparser.unparse(tree)
+        function = tree.body[1].body[0]
+        function.body[0].value.right.id = 'c'
+        function.body[1].orelse[:] = []
+        self.assertEqual(unparser.unparse(tree), self.source.replace(
+            '(a + b)', '(a + c)').replace(
+            '        else:\n            pass\n', ''))
+        self.assertEqual(unparser.unparse(tree), ast2py.unparse(tree))
+        keyword = function.body[1].body[0].value.keywords[0]
+        keyword.value.value = 1.0
+        self.assertIn('y=1.0', unparser.unparse(tree))
+
+    def test_replaced_statements_are_forgotten(self):
+        tree = ast.parse(self.source)
+        unparser = ast2py.Unparser()
+        unparser.unparse(tree)
+        function = tree.body[1].body[0]
+        old = function.body[0]
+        for value in range(10):
+            function.body[0] = ast.parse('x = (a + %d)' % value).body[0]
+            unparser.unparse(tree)
+        self.assertNotIn(id(old), unparser.cache)
+        self.assertEqual(len(unparser.cache),
+                         sum(isinstance(node, ast.stmt)
+                             for node in ast.walk(tree)))
+        # unparse() reuses the statements it rendered last.
+        ast2py.unparse(tree)
+        self.assertIn(id(function.body[0]), ast2py._unparser.cache)
+
+class TestProfile(unittest.TestCase):
+    def test_cases(self):
+        class Kind(adt.MatchCases):
+            def nil(match: Nil):
+                return 'nil'
+            def number(match: Cons(1, adt.Binding(''))):
+                return 'one'
+            def other(match: Cons):
+                return 'other'
+        new = adt.MatchCases.__dict__['__new__']
+        with adt.profile() as stats:
+            self.assertIsNot(adt.MatchCases.__dict__['__new__'], new)
+            for value in [Nil(), Cons(1, Nil()), Cons('a', Nil()),
+                          Cons('b', Nil())]:
+                Kind(value)
+            with self.assertRaises(adt.CasesExhausted):
+                Kind(1)
+        self.assertIs(adt.MatchCases.__dict__['__new__'], new)
+        Kind(Nil())
+        cases = stats.cases[Kind]
+        self.assertEqual(list(cases), ['nil', 'number', 'other'])
+        self.assertEqual(
+            [(s.attempts, s.successes, s.failures, s.failed_before)
+             for s in cases.values()],
+            [(1, 1, 0, 0), (3, 1, 2, 0), (2, 2, 0, 2)])
+        self.assertGreater(cases['other'].match_time, 0)
+        self.assertEqual(dict(stats.depths[Kind]), {1: 2, 2: 2, 0: 1})
+        self.assertEqual(stats.exhausted[Kind], 1)
+        report = stats.report()
+        self.assertIn('Kind.other: 2 failed attempts before 2 matches',
+                      report)
+
+    def test_match(self):
+        pattern = Cons(adt.Binding('x'), Nil())
+        with adt.profile() as outer:
+            with adt.profile() as inner:
+                adt.match(pattern, Cons(1, Nil()))
+            with self.assertRaises(adt.MatchFailed):
+                adt.match(pattern, Nil())
+        self.assertEqual([(s.attempts, s.successes)
+                          for s in outer.patterns.values()], [(2, 1)])
+        self.assertEqual([(s.attempts, s.successes)
+                          for s in inner.patterns.values()], [(1, 1)])
+        self.assertIn('Patterns used with match()', outer.report())
+        self.assertNotIn('profiled',
+                         adt.CompiledPattern.match.__name__)
+
+class TestReorder(unittest.TestCase):
+    def make_cases(self):
+        class Kind(adt.MatchCases):
+            def nil(match: Nil):
+                return 'nil'
+            def one(match: Cons(1, adt.Binding(''))):
+                return 'one'
+            def other(match: Cons):
+                return 'other'
+            def number(match: 1):
+                return 'number'
+            def text(match: 'a'):
+                return 'a'
+        return Kind
+
+    def names(self, cls, valuetype):
+        return [case.name for case in cls.cases_for_type(valuetype)]
+
+    def test_disjoint(self):
+        self.assertTrue(adt.disjoint(Nil, Cons))
+        self.assertTrue(adt.disjoint(Cons(1, Nil()), Cons(2, Nil())))
+        self.assertTrue(adt.disjoint(Cons(1, Nil()), Nil()))
+        self.assertTrue(adt.disjoint(1, 'a'))
+        self.assertTrue(adt.disjoint([1, 2], [1]))
+        self.assertTrue(adt.disjoint({'a': 1}, {'a': 2, 'b': 3}))
+        self.assertTrue(adt.disjoint(ast.Name, ast.Str))
+        self.assertFalse(adt.disjoint(Cons(1, adt.Binding('')), Cons))
+        self.assertFalse(adt.disjoint(1, 1.0))
+        self.assertFalse(adt.disjoint(adt.Binding('x'), 1))
+        self.assertFalse(adt.disjoint([1, adt.BindingRest('')], [1, 2]))
+        self.assertFalse(adt.disjoint([1, adt.BindingRest(''), 2], [1, 5]))
+        self.assertTrue(adt.disjoint([1, adt.BindingRest(''), 2], [2, 5]))
+        class Sequence(adt.MatchCases):
+            def first(match: [1, adt.BindingRest('x'), 2]):
+                return 'first'
+            def second(match: [1, 5]):
+                return 'second'
+        Sequence.reorder({'second': 100})
+        self.assertEqual(Sequence([1, 5]), 'first')
+        self.assertFalse(adt.disjoint(adt.ast_kwargs(ast.Assert, msg=None),
+                                      ast.Assert))
+
+    def test_reorder(self):
+        Kind = self.make_cases()
+        Kind.reorder({'other': 10, 'one': 1, 'nil': 5})
+        # 'other' can't pass 'one', which matches some of the same values.
+        self.assertEqual(self.names(Kind, Cons),
+                         ['one', 'other', 'number', 'text'])
+        self.assertEqual(self.names(Kind, Nil), ['nil', 'number', 'text'])
+        self.assertEqual(Kind(Cons(1, Nil())), 'one')
+        self.assertEqual(Kind(Cons(2, Nil())), 'other')
+        self.assertEqual(Kind(1), 'number')
+        self.assertEqual(Kind.export_order(),
+                         {'other': 10, 'one': 1, 'nil': 5})
+        Kind.reorder({})
+        self.assertEqual(self.names(Kind, Nil), ['nil', 'number', 'text'])
+
+    def test_literals(self):
+        Kind = self.make_cases()
+        Kind.reorder({'text': 3, 'number': 1})
+        self.assertEqual(self.names(Kind, str),
+                         ['text', 'number'])
+        self.assertEqual(Kind('a'), 'a')
+
+    def test_learn_order(self):
+        Kind = self.make_cases()
+        Kind.learn_order(calls=3)
+        for value in (Nil(), Cons(2, Nil()), Cons(3, Nil())):
+            Kind(value)
+        self.assertNotIn('__new__', Kind.__dict__)
+        self.assertEqual(Kind.export_order(), {'nil': 1, 'other': 2})
+        self.assertEqual(self.names(Kind, Cons),
+                         ['one', 'other', 'number', 'text'])
+        Other = self.make_cases()
+        Other.reorder(json.loads(json.dumps(Kind.export_order())))
+        self.assertEqual(Other(Nil()), 'nil')
+
+    def test_profile_stats(self):
+        Kind = self.make_cases()
+        with adt.profile() as stats:
+            for value in ('a', 'a', 1):
+                Kind(value)
+        Kind.reorder(stats.cases[Kind])
+        self.assertEqual(Kind.export_order()['text'], 2)
+
+class TestMemoize(unittest.TestCase):
+    def make_cases(self, **options):
+        calls = []
+        class Length(adt.MatchCases, **options):
+            def nil(match: Nil):
+                calls.append(match)
+                return 0
+            def cons(match: Cons(adt.Binding(''), adt.Binding('tail'))):
+                calls.append(match)
+                return 1 + Length(tail)
+            def sequence(match: [adt.BindingRest('items')]):
+                return 'sequence'
+        return Length, calls
+
+    def test_memoize(self):
+        Length, calls = self.make_cases(memoize=True)
+        lst = Cons(1, Cons(2, Nil()))
+        self.assertEqual(Length(lst), 2)
+        self.assertEqual(len(calls), 3)
+        # Equal values share the result.
+        self.assertEqual(Length(Cons(0, Cons(2, Nil()))), 2)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(Length([1, 2, 3]), 'sequence')
+        info = Length.cache_info()
+        self.assertEqual((info.hits, info.misses, info.unhashable,
+                          info.currsize), (1, 4, 1, 4))
+        self.assertAlmostEqual(info.hit_ratio, 0.2)
+
+    def test_values_of_different_types(self):
+        class Ty(adt.ADT):
+            pass
+        class Lit(Ty):
+            value = adt.Anything()
+        class Type(adt.MatchCases, memoize=True):
+            def lit(match: Lit(adt.Binding('value'))):
+                return type(value)
+            def leaf(match: Leaf(adt.Binding('value'))):
+                return type(value)
+        # All equal, but the cases see values of different types.
+        for value in (1, 1.0, True):
+            self.assertIs(Type(Lit(value)), type(value))
+            self.assertIs(Type(Leaf(value)), type(value))
+        self.assertEqual(Type.cache_info().hits, 0)
+        self.assertIs(Type(Lit(1.0)), float)
+        self.assertIs(Type(Leaf(True)), bool)
+        self.assertEqual(Type.cache_info().hits, 2)
+
+    def test_invalidate(self):
+        Length, calls = self.make_cases(memoize=True)
+        Length(Cons(1, Nil()))
+        Length.invalidate(Nil())
+        self.assertEqual(Length.cache_info().currsize, 1)
+        Length.invalidate()
+        Length(Cons(1, Nil()))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(Length.cache_info().misses, 4)
+
+    def test_maxsize(self):
+        Length, calls = self.make_cases(memoize=True, maxsize=2)
+        lst = Cons(1, Cons(2, Cons(3, Nil())))
+        Length(lst)
+        self.assertEqual(Length.cache_info().currsize, 2)
+        # The outermost results were the last used.
+        Length(lst)
+        self.assertEqual(len(calls), 4)
+
+    def test_not_memoized(self):
+        Length, calls = self.make_cases()
+        Length(Nil())
+        Length(Nil())
+        self.assertEqual(len(calls), 2)
+        with self.assertRaises(TypeError):
+            Length.cache_info()
+        Memoized, calls = self.make_cases(memoize=True)
+        class Subclass(Memoized):
+            def nil(match: Nil):
+                return -1
+        self.assertEqual(Subclass(Nil()), -1)
+        self.assertEqual(Memoized.cache_info().misses, 0)
+
+class TestRegexCases(unittest.TestCase):
+    def make_cases(self):
+        class Token(adt.MatchCases):
+            def number(match: re.compile(r'(?P<digits>\d+)(?:\.(?P<frac>\d+))?')):
+                return ('number', digits, frac)
+            def word(match: re.compile(r'(?P<word>[a-z]+)')):
+                return ('word', word)
+            def keyword(match: re.compile(r'if')):
+                return 'unreachable'
+            def space(match: re.compile(r'\s+')):
+                return 'space'
+            def other(match: adt.Binding('text')):
+                return ('other', text)
+        return Token
+
+    def test_combined(self):
+        Token = self.make_cases()
+        self.assertEqual(Token('12.5'), ('number', '12', '5'))
+        self.assertEqual(Token('if'), ('word', 'if'))
+        self.assertEqual(Token('  '), 'space')
+        self.assertEqual(Token('+'), ('other', '+'))
+        self.assertEqual(Token(3), ('other', 3))
+        cases = Token._case_table[str]
+        self.assertEqual([case.name for case in cases],
+                         ['number|word|keyword|space', 'other'])
+        self.assertEqual([case.name for case in Token._case_table[int]],
+                         ['other'])
+
+    def test_profile_and_learn(self):
+        Token = self.make_cases()
+        with adt.profile() as stats:
+            for text in ('12', 'if', ' ', '+'):
+                Token(text)
+        cases = stats.cases[Token]
+        self.assertEqual(cases['word'].attempts, 3)
+        self.assertEqual(cases['word'].successes, 1)
+        self.assertEqual(cases['space'].failed_before, 3)
+        self.assertEqual(cases['keyword'].successes, 0)
+        self.assertIn('number', stats.report())
+        Token.learn_order(calls=3)
+        for text in ('ab', 'cd', '1'):
+            Token(text)
+        self.assertEqual(Token.export_order(),
+                         {'word': 2, 'number': 1})
+        self.assertEqual(Token('7'), ('number', '7', None))
+
+    def test_not_combined(self):
+        class Repeated(adt.MatchCases):
+            def double(match: re.compile(r'(?P<c>.)(?P=c)')):
+                return 'double'
+            def single(match: re.compile(r'(?P<c>.)')):
+                return c
+        self.assertEqual(Repeated('aa'), 'double')
+        self.assertEqual(Repeated('ab'), 'a')
+        self.assertEqual(len(Repeated._case_table[str]), 2)
+
+    def test_bytes(self):
+        class Line(adt.MatchCases):
+            def error(match: re.compile(rb'ERROR (?P<message>.*)')):
+                return ('error', message)
+            def info(match: re.compile(rb'INFO (?P<message>.*)')):
+                return ('info', message)
+        buffer = memoryview(b'INFO started')
+        self.assertEqual(Line(buffer), ('info', b'started'))
+        self.assertEqual(Line(bytearray(b'ERROR failed')),
+                         ('error', b'failed'))
+        with self.assertRaises(adt.CasesExhausted):
+            Line('INFO text')
+        self.assertEqual(adt.match(re.compile(rb'(?P<x>.)'),
+                                   memoryview(b'xy')).x, b'x')
+
+    def test_match_wrong_type(self):
+        pattern = re.compile(r'(?P<x>\d)(?P<y>\d)')
+        with self.assertRaises(adt.MatchFailed):
+            adt.match(pattern, b'12')
+        self.assertEqual(list(adt.extract_bindings(pattern)), ['x', 'y'])
+        self.assertEqual(list(adt.match_iter(pattern, ['12', 3, '34'])),
+                         [('1', '2'), ('3', '4')])
+
+class TestMappingPatterns(unittest.TestCase):
+    pattern = {'b': adt.Binding('b'), 'a': adt.Binding('a'), 'c': 3}
+
+    def test_missing_key_before_values(self):
+        # The missing key is found before 'b' would fail to match.
+        for match in (adt.match, self.interpret, self.match_iterative):
+            with self.assertRaisesRegex(adt.MatchFailed, "'c'"):
+                match({'a': Cons, 'b': adt.Binding(''), 'c': 3},
+                      {'a': 1, 'b': 2})
+            self.assertEqual(match(self.pattern,
+                                   {'a': 1, 'b': 2, 'c': 3, 'd': 4}),
+                             (1, 2))
+
+    def test_exact_keys(self):
+        pattern = adt.ExactKeys([('b', adt.Binding('b')), ('a', 1)])
+        for match in (adt.match, self.interpret, self.match_iterative):
+            self.assertEqual(match(pattern, {'a': 1, 'b': 2}), (2,))
+            with self.assertRaisesRegex(adt.MatchFailed, 'not in the pattern'):
+                match(pattern, {'a': 1, 'b': 2, 'c': 3})
+            with self.assertRaisesRegex(adt.MatchFailed, "'b'"):
+                match(pattern, {'a': 1, 'c': 3})
+        self.assertTrue(adt.disjoint(pattern, {'c': adt.Binding('c')}))
+        self.assertFalse(adt.disjoint(pattern, {'a': adt.Binding('a')}))
+
+    def test_mapping_values(self):
+        class Pairs:
+            # A mapping whose keys() is not a set-like view.
+            def __init__(self, **items):
+                self.items = items
+            def keys(self):
+                return list(self.items)
+            def values(self):
+                return list(self.items.values())
+            def __contains__(self, key):
+                return key in self.items
+            def __getitem__(self, key):
+                return self.items[key]
+            def __len__(self):
+                return len(self.items)
+        self.assertEqual(adt.match(self.pattern, Pairs(a=1, b=2, c=3)),
+                         (1, 2))
+        with self.assertRaises(adt.MatchFailed):
+            adt.match(self.pattern, Pairs(a=1, b=2))
+        with self.assertRaises(adt.MatchFailed):
+            adt.match(self.pattern, [1, 2, 3])
+
+    def match_iterative(self, pattern, value):
+        return adt.compile_iterative(pattern).match(value)
+
+    def interpret(self, pattern, value):
+        return tuple(interpret(pattern, value).values())
+
 if __name__ ==  '__main__':
     unittest.main()